@@ -0,0 +1,123 @@
+'''Fast alignment of the images to the background image.
+
+Works like imreg_dft, but the Fourier transforms of the background are calculated only once and the
+estimation runs on a downsampled image. Rotation and scale are found by phase correlation of the
+log-polar transformed magnitude spectra, the translation by phase correlation of the images.
+The translation is then refined on a crop at full resolution.'''
+import numpy as np
+import cv2
+
+def spectrum(image):
+    '''Returns the complex Fourier transform of the image as two channel array'''
+    return cv2.dft(np.float32(image), flags=cv2.DFT_COMPLEX_OUTPUT)
+
+def phase_correlation(spectrum_reference, spectrum_image):
+    '''Returns the shift (x, y) of the image relative to the reference and the height of the correlation peak'''
+    cross = cv2.mulSpectrums(spectrum_image, spectrum_reference, 0, conjB=True)
+    cross /= cv2.magnitude(cross[..., 0], cross[..., 1])[..., None] + 1e-12
+    correlation = cv2.idft(cross, flags=cv2.DFT_REAL_OUTPUT | cv2.DFT_SCALE)
+
+    height, width = correlation.shape
+    y, x = np.unravel_index(np.argmax(correlation), correlation.shape)
+
+    # Subpixel position as centroid of the 3x3 neighbourhood, the correlation is periodic
+    neighbourhood = correlation[np.ix_([(y - 1) % height, y, (y + 1) % height], [(x - 1) % width, x, (x + 1) % width])]
+    neighbourhood = np.clip(neighbourhood, 0, None)
+    offset_y, offset_x = np.array([[-1], [0], [1]]), np.array([-1, 0, 1])
+    total = neighbourhood.sum() + 1e-12
+    x = x + (neighbourhood * offset_x).sum() / total
+    y = y + (neighbourhood * offset_y).sum() / total
+
+    # Shifts larger than half of the image are negative shifts
+    x = x - width if x > width / 2 else x
+    y = y - height if y > height / 2 else y
+    return (x, y), correlation.max()
+
+def highpass(shape):
+    '''Highpass filter for the centred magnitude spectrum, as in imreg_dft'''
+    y = np.cos(np.pi * np.linspace(-0.5, 0.5, shape[0]))[:, None]
+    x = np.cos(np.pi * np.linspace(-0.5, 0.5, shape[1]))[None, :]
+    return (1.0 - x * y) * (2.0 - x * y)
+
+class Aligner:
+    '''Aligns images to a background image, everything that depends only on the background is calculated once'''
+    def __init__(self, background, downscale=6, refine_size=512, max_angle=10, max_scale=0.1):
+        self.shape = background.shape
+        self.downscale = downscale
+        self.max_angle = max_angle
+        self.max_scale = max_scale
+
+        small = self.downsample(background)
+        self.small_shape = small.shape
+        self.window = cv2.createHanningWindow(small.shape[::-1], cv2.CV_32F)
+        self.spectrum = spectrum(small * self.window)
+
+        # Rotation and scale are estimated on a square crop, otherwise the spectrum would not rotate with the image
+        self.square = min(small.shape)
+        self.window_square = cv2.createHanningWindow((self.square, self.square), cv2.CV_32F)
+        self.highpass = highpass((self.square, self.square)).astype(np.float32)
+        self.spectrum_logpolar = spectrum(self.logpolar(small))
+
+        # Central crop of the background at full resolution for the refinement of the translation
+        self.refine_size = min(refine_size, *self.shape) if refine_size else 0
+        if self.refine_size:
+            self.crop_origin = ((self.shape[1] - self.refine_size) // 2, (self.shape[0] - self.refine_size) // 2)
+            self.window_refine = cv2.createHanningWindow((self.refine_size, self.refine_size), cv2.CV_32F)
+            x, y = self.crop_origin
+            self.spectrum_refine = spectrum(background[y:y + self.refine_size, x:x + self.refine_size] * self.window_refine)
+
+    def downsample(self, image):
+        return cv2.resize(image, (image.shape[1] // self.downscale, image.shape[0] // self.downscale), interpolation=cv2.INTER_AREA)
+
+    def logpolar(self, small):
+        '''Log-polar transform of the magnitude spectrum of the central square, rotation and scaling become shifts along the axes'''
+        y, x = (small.shape[0] - self.square) // 2, (small.shape[1] - self.square) // 2
+        magnitude = cv2.magnitude(*cv2.split(spectrum(small[y:y + self.square, x:x + self.square] * self.window_square)))
+        magnitude = np.fft.fftshift(magnitude) * self.highpass
+        return cv2.warpPolar(magnitude, (self.square, self.square), (self.square / 2, self.square / 2), self.square / 2,
+                             cv2.WARP_POLAR_LOG + cv2.INTER_LINEAR)
+
+    def estimate(self, image):
+        '''Returns the affine matrix, which maps the image onto the background at full resolution.
+           The identity is returned if the estimated rotation or scale is implausible.'''
+        small = self.downsample(image)
+        height, width = self.small_shape
+
+        # Rotation and scale, the magnitude spectrum repeats every 180 degree
+        (shift_radius, shift_angle), _ = phase_correlation(self.spectrum_logpolar, spectrum(self.logpolar(small)))
+        angle = shift_angle * 360 / self.square
+        angle = (angle + 90) % 180 - 90
+        scale = np.exp(shift_radius * np.log(self.square / 2) / self.square)
+        if abs(angle) > self.max_angle or abs(scale - 1) > self.max_scale:
+            angle, scale = 0.0, 1.0
+
+        # Translation of the rotated and scaled image
+        rotation = cv2.getRotationMatrix2D((width / 2, height / 2), angle, scale)
+        rotated = cv2.warpAffine(small, rotation, (width, height), borderMode=cv2.BORDER_REPLICATE)
+        (shift_x, shift_y), _ = phase_correlation(self.spectrum, spectrum(rotated * self.window))
+
+        matrix = cv2.getRotationMatrix2D((self.shape[1] / 2, self.shape[0] / 2), angle, scale)
+        matrix[:, 2] -= np.array([shift_x, shift_y]) * self.downscale
+
+        if self.refine_size:
+            # Remaining translation on a crop at full resolution
+            crop = matrix.copy()
+            crop[:, 2] -= self.crop_origin
+            cropped = cv2.warpAffine(image, crop, (self.refine_size, self.refine_size), borderMode=cv2.BORDER_REPLICATE)
+            (shift_x, shift_y), _ = phase_correlation(self.spectrum_refine, spectrum(cropped * self.window_refine))
+            if max(abs(shift_x), abs(shift_y)) <= self.downscale:
+                matrix[:, 2] -= (shift_x, shift_y)
+
+        return matrix
+
+    def align(self, image):
+        '''Returns the image aligned to the background, the image is not copied if it is already aligned'''
+        matrix = self.estimate(image)
+
+        # Largest displacement of a corner, below half a pixel the warp would not change the image
+        height, width = self.shape
+        corners = np.array([[0, 0, 1], [width, 0, 1], [0, height, 1], [width, height, 1]])
+        if np.abs(corners @ matrix.T - corners[:, :2]).max() < 0.5:
+            return image
+
+        return cv2.warpAffine(image, matrix, (width, height), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
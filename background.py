@@ -0,0 +1,59 @@
+'''Models of the background, which is subtracted from the aligned images.
+
+static subtracts always the same background image. ema and median follow the slow changes of the lighting and the
+condensation during a long run: they start with the background image and learn from every frame after it was
+analysed. An update takes O(pixels) and no earlier frames are kept. New models are added to MODELS.'''
+import numpy as np
+import cv2
+
+import util  # Selfmade library
+
+class StaticBackground:
+    '''The background image, the same for every frame'''
+    def __init__(self, background, window):
+        self.background = util.prepareBackground(background)
+
+    def prepared(self):
+        '''Returns the background prepared for util.subtractBackground'''
+        return self.background
+
+    def update(self, image):
+        pass
+
+class EmaBackground:
+    '''Exponential moving average, every frame has the weight 1 / window, so the last window frames count most'''
+    def __init__(self, background, window):
+        self.average = np.float32(background)
+        self.alpha = 1 / max(window, 1)
+
+    def prepared(self):
+        return util.prepareBackground(np.rint(self.average))
+
+    def update(self, image):
+        cv2.accumulateWeighted(image, self.average, self.alpha)
+
+class MedianBackground:
+    '''Approximate running median (McFarlane and Schofield): every pixel moves by one gray level towards the frame.
+       A pixel which is above the median in half of the frames stays at the median, a track which is bright in a few
+       frames only moves it a few gray levels. Unlike a histogram per pixel, it needs only one image of memory.'''
+    def __init__(self, background, window):
+        self.median = np.array(background, dtype=np.uint8)
+
+    def prepared(self):
+        return util.prepareBackground(self.median)
+
+    def update(self, image):
+        # cv2.add and cv2.subtract saturate, so the median stays within 0 and 255
+        brighter = cv2.compare(image, self.median, cv2.CMP_GT) // 255
+        darker = cv2.compare(image, self.median, cv2.CMP_LT) // 255
+        cv2.subtract(cv2.add(self.median, brighter), darker, dst=self.median)
+
+MODELS = {
+    'static': StaticBackground,
+    'ema': EmaBackground,
+    'median': MedianBackground,
+}
+
+def create(model, background, window):
+    '''Returns the model of the background, which starts with the background image'''
+    return MODELS[model](background, window)
@@ -0,0 +1,301 @@
+'''Benchmarks for the cloud chamber program, the results are printed as JSON.'''
+import numpy as np
+import cv2
+import imageio
+import json
+import os
+import time
+import tempfile
+import subprocess
+import sys
+import tracemalloc
+from argparse import ArgumentParser
+
+import util  # Selfmade library
+import codec
+import cloudchamber
+from align import Aligner
+from detectors import DETECTORS
+
+directory = os.path.dirname(os.path.abspath(__file__))
+
+def measure_time(func, *args):
+    '''Returns the result of func and the time it took in seconds'''
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+def measure_memory(func, *args):
+    '''Returns the result of func and the peak of the memory allocated by it in bytes'''
+    tracemalloc.start()
+    result = func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, peak
+
+def benchmark_lineset(segments):
+    '''Compares building a LineSet with building Line objects, both extrapolated to one million segments'''
+    rng = np.random.default_rng(0)
+    # Same layout as the result of cv2.HoughLinesP
+    points = rng.integers(0, 4608, (segments, 1, 4), dtype=np.int32)
+    per_million = 10**6 / segments
+
+    lineSet, lineset_seconds = measure_time(util.LineSet.fromPoints, points, 'benchmark.jpg')
+    _, lineset_bytes = measure_memory(util.LineSet.fromPoints, points, 'benchmark.jpg')
+
+    def create_line_objects(points):
+        return [util.Line(x1, y1, x2, y2, 'benchmark.jpg') for x1, y1, x2, y2 in points.reshape(-1, 4).tolist()]
+
+    _, objects_seconds = measure_time(create_line_objects, points)
+    _, objects_bytes = measure_memory(create_line_objects, points)
+
+    return {
+        'segments': segments,
+        'lineset_seconds_per_million': lineset_seconds * per_million,
+        'lineset_bytes_per_million': lineSet.nbytes * per_million,
+        'lineset_peak_bytes_per_million': lineset_bytes * per_million,
+        'line_objects_seconds_per_million': objects_seconds * per_million,
+        'line_objects_peak_bytes_per_million': objects_bytes * per_million,
+    }
+
+def benchmark_align(repeat):
+    '''Times the fast alignment of the example image to the background, the Aligner is created once'''
+    background = imageio.imread(os.path.join(directory, 'background', 'background.jpg'), pilmode='L')
+    image = imageio.imread(os.path.join(directory, 'example_data', 'Nebelkammer_000.jpg'), pilmode='L')
+
+    aligner, setup_seconds = measure_time(Aligner, background)
+    _, estimate_seconds = measure_time(lambda: [aligner.estimate(image) for _ in range(repeat)])
+    # Shifted by a few pixels, so that the image is warped
+    shifted = np.roll(image, (3, -5), axis=(0, 1))
+    _, align_seconds = measure_time(lambda: [aligner.align(shifted) for _ in range(repeat)])
+
+    return {
+        'resolution': '%dx%d' % image.shape[::-1],
+        'setup_seconds': setup_seconds,
+        'estimate_seconds_per_frame': estimate_seconds / repeat,
+        'align_seconds_per_frame': align_seconds / repeat,
+    }
+
+def synthetic_background(shape, rng):
+    '''Dark background with a brighter centre, like the illuminated chamber of the example images'''
+    y, x = np.ogrid[-1:1:shape[0] * 1j, -1:1:shape[1] * 1j]
+    background = 12 - 6 * (x ** 2 + y ** 2) + rng.normal(0, 1, shape)
+    return np.uint8(np.clip(cv2.GaussianBlur(background, (0, 0), 3), 0, 255))
+
+def synthetic_frame(background, tracks, noise, rng):
+    '''Adds tracks of random position, length, width and brightness and gaussian noise to the background.
+       The lengths and widths scale with the resolution, so that a frame looks the same at every resolution.'''
+    height, width = background.shape
+    scale = width / 4608
+    frame = np.float32(background)
+    for _ in range(tracks):
+        x, y = rng.uniform(0, width), rng.uniform(0, height)
+        length = rng.uniform(300, 1500) * scale
+        angle = rng.uniform(0, np.pi)
+        end = (int(x + length * np.cos(angle)), int(y + length * np.sin(angle)))
+        thickness = max(1, int(rng.uniform(4, 12) * scale))
+        cv2.line(frame, (int(x), int(y)), end, float(rng.uniform(40, 100)), thickness)
+        frame = np.maximum(frame, background)
+    # The tracks are blurred like the trails of droplets
+    frame = cv2.GaussianBlur(frame, (0, 0), max(1, 2 * scale)) + rng.normal(0, noise, background.shape)
+    return np.uint8(np.clip(frame, 0, 255))
+
+def measure_stage(func, *args):
+    '''Returns the result of func, the time it took and the peak of the memory allocated by it.
+       The memory is measured in a second call, as tracemalloc slows down the call.'''
+    result, seconds = measure_time(func, *args)
+    _, peak = measure_memory(func, *args)
+    return result, seconds, peak
+
+def benchmark_pipeline(resolution, tracks, noise, frames):
+    '''Times every stage of the pipeline on synthetic frames, the options of the stages are the default options'''
+    width, height = resolution
+    rng = np.random.default_rng(0)
+    options = cloudchamber.parse_args(['--no_cache', 'benchmark.jpg'])
+    cloudchamber.configure(options)
+
+    background = synthetic_background((height, width), rng)
+    aligner = Aligner(background)
+    prepared = util.prepareBackground(background)
+
+    times = {}
+    peaks = {}
+    def add(stage, seconds, peak):
+        times.setdefault(stage, []).append(seconds)
+        peaks[stage] = max(peaks.get(stage, 0), peak)
+
+    counts_unfiltered, counts_filtered = [], []
+    with tempfile.TemporaryDirectory() as directory:
+        for number in range(frames):
+            frame = synthetic_frame(background, tracks, noise, rng)
+            image = os.path.join(directory, 'frame_%03d.jpg' % number)
+
+            img_aligned, *measured = measure_stage(aligner.align, frame)
+            add('align', *measured)
+            img_wo_bkgnd, *measured = measure_stage(util.subtractBackground, img_aligned, prepared)
+            add('remove_background', *measured)
+            lines_unfiltered, *measured = measure_stage(cloudchamber.detect_line, img_wo_bkgnd, image)
+            add('detect_line', *measured)
+            lines_filtered, *measured = measure_stage(util.filterLines, lines_unfiltered)
+            add('filterLines', *measured)
+            overlay_unfiltered, *measured = measure_stage(util.colorImageWithLines, lines_unfiltered, img_wo_bkgnd, options.preview_scale)
+            add('colorImageWithLines', *measured)
+            overlay_filtered = util.colorImageWithLines(lines_filtered, img_wo_bkgnd, options.preview_scale)
+
+            # The result figure is plotted from the files of the intermediate images
+            cloudchamber.write_image(image, frame)
+            cloudchamber.write_image(cloudchamber.intermediate_path(image, '_wo_bkgnd'), img_wo_bkgnd)
+            cloudchamber.write_image(cloudchamber.intermediate_path(image, '_unfiltered_lines'), overlay_unfiltered, options.preview_quality)
+            cloudchamber.write_image(cloudchamber.intermediate_path(image, '_filtered_lines'), overlay_filtered, options.preview_quality)
+            _, *measured = measure_stage(cloudchamber.plot_result, image, len(lines_unfiltered), len(lines_filtered),
+                                         cloudchamber.intermediate_path(image, '_result'))
+            add('plot_result', *measured)
+
+            counts_unfiltered.append(len(lines_unfiltered))
+            counts_filtered.append(len(lines_filtered))
+
+    megapixels = width * height / 10**6
+    stages = {}
+    for stage, seconds in times.items():
+        median = float(np.median(seconds))
+        stages[stage] = {
+            'seconds_per_frame': median,
+            'frames_per_second': 1 / median if median else None,
+            'megapixels_per_second': megapixels / median if median else None,
+            'peak_bytes': peaks[stage],
+        }
+
+    return {
+        'resolution': '%dx%d' % resolution,
+        'tracks': tracks,
+        'noise': noise,
+        'frames': frames,
+        'lines_unfiltered_per_frame': float(np.mean(counts_unfiltered)),
+        'lines_filtered_per_frame': float(np.mean(counts_filtered)),
+        'stages': stages,
+    }
+
+def benchmark_detectors(resolution, tracks, noise, frames):
+    '''Compares the detectors by the number of segments and the time for detecting and filtering them together,
+       as more segments make filterLines slower'''
+    width, height = resolution
+    rng = np.random.default_rng(0)
+    background = synthetic_background((height, width), rng)
+    prepared = util.prepareBackground(background)
+    images = [util.subtractBackground(synthetic_frame(background, tracks, noise, rng), prepared) for _ in range(frames)]
+
+    results = {}
+    for detector in sorted(DETECTORS):
+        cloudchamber.configure(cloudchamber.parse_args(['--no_cache', '--detector', detector, 'benchmark.jpg']))
+        detect_seconds, filter_seconds, segments, segments_filtered = [], [], [], []
+        for image in images:
+            lines, seconds = measure_time(cloudchamber.detect_line, image, 'benchmark.jpg')
+            detect_seconds.append(seconds)
+            lines_filtered, seconds = measure_time(cloudchamber.filter_line, lines)
+            filter_seconds.append(seconds)
+            segments.append(len(lines))
+            segments_filtered.append(len(lines_filtered))
+
+        results[detector] = {
+            'segments_per_frame': float(np.mean(segments)),
+            'segments_filtered_per_frame': float(np.mean(segments_filtered)),
+            'detect_seconds_per_frame': float(np.median(detect_seconds)),
+            'filter_seconds_per_frame': float(np.median(filter_seconds)),
+            'seconds_per_frame': float(np.median(np.add(detect_seconds, filter_seconds))),
+        }
+
+    return {'resolution': '%dx%d' % resolution, 'tracks': tracks, 'noise': noise, 'frames': frames, 'detectors': results}
+
+def benchmark_io(resolution, repeat):
+    '''Times reading and writing a synthetic frame with every installed codec, per frame.
+       imageio at full resolution is the old way, the previews are written reduced by the default --preview_scale.'''
+    width, height = resolution
+    rng = np.random.default_rng(0)
+    frame = synthetic_frame(synthetic_background((height, width), rng), 10, 2, rng)
+    options = cloudchamber.parse_args(['--no_cache', 'benchmark.jpg'])
+    preview = cv2.resize(frame, None, fx=options.preview_scale, fy=options.preview_scale, interpolation=cv2.INTER_AREA)
+    factor = codec.reduction(options.result_scale)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'frame.jpg')
+        codec.write(path, frame, 'opencv', options.jpeg_quality)
+        for name in codec.available():
+            def median(func, *args):
+                return float(np.median([measure_time(func, *args)[1] for _ in range(repeat)]))
+
+            output = os.path.join(directory, 'output.jpg')
+            results[name] = {
+                'read_seconds_per_frame': median(codec.read, path, name),
+                'read_reduced_seconds_per_frame': median(codec.read, path, name, factor),
+                'write_seconds_per_frame': median(codec.write, output, frame, name, options.jpeg_quality),
+                'write_preview_seconds_per_frame': median(codec.write, output, preview, name, options.preview_quality),
+            }
+
+    return {'resolution': '%dx%d' % resolution, 'reduction': factor, 'preview_scale': options.preview_scale, 'codecs': results}
+
+# Commands whose start is timed, they return without analysing images
+STARTUP_COMMANDS = {
+    'cloudchamber -h': ['cloudchamber.py', '-h'],
+    'cloudchamber -v': ['cloudchamber.py', '-v'],
+    'cloudchamber -f': ['cloudchamber.py', '-f', '--no_cache', 'benchmark.jpg'],
+    'store': ['store.py', 'lines_filtered'],
+    'tracks -h': ['tracks.py', '-h'],
+    'plot -h': ['plot.py', '-h'],
+}
+
+def benchmark_startup(repeat):
+    '''Times the start of the command line programs in a new Python process, in an empty folder'''
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        def run(arguments):
+            subprocess.run([sys.executable] + arguments, cwd=folder, stdout=subprocess.DEVNULL, check=True)
+
+        for name, command in STARTUP_COMMANDS.items():
+            arguments = [os.path.join(directory, command[0])] + command[1:]
+            results[name] = {'seconds': float(np.median([measure_time(run, arguments)[1] for _ in range(repeat)]))}
+
+        # The start of Python itself, which no program can avoid
+        results['python'] = {'seconds': float(np.median([measure_time(run, ['-c', 'pass'])[1] for _ in range(repeat)]))}
+    return results
+
+def resolution(text):
+    '''Parses a resolution like 4608x3072'''
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+def main():
+    parser = ArgumentParser(description="Benchmarks for the cloud chamber program")
+    parser.add_argument('--segments', type=int, default=10**6, help='number of line segments for the LineSet benchmark')
+    parser.add_argument('--repeat', type=int, default=10, help='number of repetitions of the timed frames')
+    parser.add_argument('--suites', nargs='+', choices=['lineset', 'align', 'pipeline', 'detectors', 'io', 'startup'],
+                        default=['lineset', 'align', 'pipeline', 'detectors', 'io', 'startup'],
+                        help='benchmarks to run')
+    parser.add_argument('--resolutions', type=resolution, nargs='+', default=[(4608, 3072)], metavar='WxH',
+                        help='resolutions of the synthetic frames')
+    parser.add_argument('--tracks', type=int, nargs='+', default=[10], help='numbers of tracks per synthetic frame')
+    parser.add_argument('--noise', type=float, nargs='+', default=[2], help='standard deviations of the noise of the synthetic frames')
+    parser.add_argument('--frames', type=int, default=3, help='number of synthetic frames per combination')
+    args = parser.parse_args()
+
+    results = {}
+    if 'lineset' in args.suites:
+        results['lineset'] = benchmark_lineset(args.segments)
+    if 'align' in args.suites:
+        results['align'] = benchmark_align(args.repeat)
+    if 'pipeline' in args.suites:
+        results['pipeline'] = [benchmark_pipeline(resolution, tracks, noise, args.frames)
+                               for resolution in args.resolutions for tracks in args.tracks for noise in args.noise]
+    if 'detectors' in args.suites:
+        results['detectors'] = [benchmark_detectors(resolution, tracks, noise, args.frames)
+                                for resolution in args.resolutions for tracks in args.tracks for noise in args.noise]
+
+    if 'io' in args.suites:
+        results['io'] = [benchmark_io(resolution, args.repeat) for resolution in args.resolutions]
+    if 'startup' in args.suites:
+        results['startup'] = benchmark_startup(args.repeat)
+
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
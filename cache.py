@@ -0,0 +1,120 @@
+'''Content-hashed cache for the results of the stages.
+
+The key of a stage is a hash of the key of the previous stage, the hashes of the other input files and the
+parameters of the stage. So if a parameter changes, only the keys of this stage and the stages after it change.
+Every entry is a file named after its key in the cache folder. The least recently used entries are removed,
+when the folder gets larger than the given size.'''
+import os
+import json
+import shutil
+import hashlib
+import functools
+
+from store import writeLines, readLines
+
+def hash_file(path):
+    '''Returns the SHA-1 of the content of the file'''
+    stat = os.stat(path)
+    return _hash_file(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+@functools.lru_cache(maxsize=4096)
+def _hash_file(path, size, mtime):
+    # Size and modification time are part of the arguments, so that a changed file is hashed again
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def stage_key(stage, inputs, **parameters):
+    '''Returns the key of a stage from the keys or hashes of its inputs and its parameters'''
+    description = json.dumps([stage, inputs, parameters], sort_keys=True)
+    return hashlib.sha1(description.encode()).hexdigest()
+
+class StageCache:
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.added = 0  # Bytes added by this process since the last eviction
+
+    def entry(self, key, ending):
+        return os.path.join(self.path, key + ending)
+
+    def get_file(self, key, ending, destination):
+        '''Copies the entry to destination, returns False if there is no entry'''
+        path = self.entry(key, ending)
+        try:
+            os.utime(path)  # Marks the entry as recently used
+            shutil.copyfile(path, destination)
+        except FileNotFoundError:
+            return False  # Also if another process evicts the entry meanwhile
+        return True
+
+    def put_file(self, key, ending, source):
+        '''Copies the file source into the cache'''
+        with open(source, 'rb') as file_source:
+            self._put(key, ending, lambda file: shutil.copyfileobj(file_source, file))
+
+    def get_lines(self, key):
+        '''Returns the LineSet of the entry or None'''
+        path = self.entry(key, '.npz')
+        try:
+            os.utime(path)
+            return readLines(path)
+        except FileNotFoundError:
+            return None
+
+    def put_lines(self, key, lines):
+        self._put(key, '.npz', lambda file: writeLines(file, lines))
+
+    def _put(self, key, ending, write):
+        os.makedirs(self.path, exist_ok=True)
+        path = self.entry(key, ending)
+
+        # Written under a temporary name first, so that other processes never read an incomplete entry
+        path_tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(path_tmp, 'wb') as file:
+            write(file)
+        self.added += os.path.getsize(path_tmp)
+        os.replace(path_tmp, path)
+
+        # The folder is only scanned after a tenth of the size was added, so it can grow a bit beyond max_bytes
+        if self.added > self.max_bytes / 10:
+            self.evict()
+
+    def size(self):
+        '''Returns the size of all entries in bytes'''
+        return sum(size for _, size, _ in self._entries())
+
+    def _entries(self):
+        if not os.path.isdir(self.path):
+            return []
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue  # Evicted by another process
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        '''Removes the least recently used entries, until the cache is not larger than max_bytes'''
+        self.added = 0
+        entries = sorted(self._entries())
+        size = sum(size for _, size, _ in entries)
+        for _, size_entry, path in entries:
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= size_entry
+
+    def clear(self):
+        '''Removes all entries'''
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
@@ -1,226 +1,746 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import cv2
-import imreg_dft as ird
-import imageio # Newer than 2.2.0 must be used to use pilmode e.g. pip install git+https://github.com/imageio/imageio.git
 from multiprocessing import Pool
 
 import os
-import pandas
 import time
+import functools
+import contextlib
+import collections
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from argparse import ArgumentParser
 import sys
 
 import util  # Selfmade library
-
-# Source: https://stackoverflow.com/questions/2507808/python-check-whether-a-file-is-empty-or-not?noredirect=1&lq=1
-def is_zero_file(fpath):
-    '''Checks if a file does not exist or is empty.'''
-    return not(os.path.isfile(fpath) and os.path.getsize(fpath) > 0)
-
-def time_dec(func):
-    def wrapper(*arg):
-        print(func.__name__,':', arg[0], end='', flush=True)
-        start = time.time()
-
-        res = func(*arg)
-
-        print(' -> %.1fs' % (time.time() - start))
-        return res
-
-    return wrapper
-
-def plot_result_images(images):
-    @time_dec
-    def plot_result_image(image, lines_unfiltered, lines_filtered):
-        file, ending = os.path.splitext(image)
-
-        fig, axes = plt.subplots(nrows=2, ncols=2)
-
-        axes[0][0].imshow(imageio.imread(file + ending, pilmode='L'), cmap='gist_gray')
-        axes[0][0].set_title('Image to be analyzed')
-        axes[0][0].axis('off')
-
-        axes[0][1].imshow(imageio.imread(file + '_wo_bkgnd' + ending, pilmode='L'), cmap='gist_gray')
-        axes[0][1].set_title('Removed backround')
-        axes[0][1].axis('off')
-
-        axes[1][0].imshow(imageio.imread(file + '_unfiltered_lines' + ending, pilmode='L'), cmap='gist_gray')
-        axes[1][0].set_title('Detected ' + lines_unfiltered + ' lines before filtering')
-        axes[1][0].axis('off')
-
-        axes[1][1].imshow(imageio.imread(file + '_filtered_lines' + ending, pilmode='L'), cmap='gist_gray')
-        axes[1][1].set_title('Detected ' + lines_filtered + ' lines after filtering')
-        axes[1][1].axis('off')
-
-        file, ending = os.path.splitext(image)
-        plt.savefig(
-            file + '_result' + ending,
-            dpi=400,
-            bbox_inches='tight',
-            pad_inches=0,
-            transparent="True",)
-
-    df_unfiltered = pandas.read_csv('lines_unfiltered.csv')
-    df_filtered = pandas.read_csv('lines_filtered.csv')
-
-    filenames_unfiltered = set(df_unfiltered.filename)
-    filenames_filtered = set(df_filtered.filename)
-    for image in images:
-
-        df_filename_unfiltered = df_unfiltered[df_unfiltered.filename == image]
-        df_filename_filtered = df_filtered[df_filtered.filename == image]
-
-        plot_result_image(image, str(len(df_filename_unfiltered)), str(len(df_filename_filtered)))
-
-# Install pyfftw for better performance.
-def align_images(images):
-    @time_dec
-    def align_image(path_analyse, img_background):
-        # Load analyse image
-        img_analyse = imageio.imread(path_analyse, pilmode='L')
-
-        # Align img_analyse to img_background
-        # It has to be Homography transformation(very slow), because images are shifted, twisted, scaled and distorted (3D)
-        # First tried to use opencv (https://www.learnopencv.com/image-alignment-ecc-in-opencv-c-python/), but got miserable results
-        # Found on github https://github.com/matejak/imreg_dft a pretty good library
-        #img_analyse_aligned = ird.similarity(img_background, img_analyse, numiter=3)['timg']
-        img_analyse_aligned = img_analyse # TODO: Remove, fast variant for testing
-
-        return img_analyse_aligned
-
-    # Start here
-    img_background = imageio.imread(os.path.join('background', 'background.jpg'), pilmode='L')
-    # ‘L’ (8-bit pixels, black and white)
-
-    for path_analyse in images:
-        img_aligned = align_image(path_analyse, img_background)
-
-        file, ending = os.path.splitext(path_analyse)
-        imageio.imsave(file + '_align' + ending, img_aligned, format='jpg')
-
-    # Use multithreader, number in Pool defines number of processes
-    # with Pool(1) as p:
-    #     p.map(align_image, images)
-
-def remove_backgrounds(images):
-    @time_dec
-    def remove_background(path_analyse, img_background):
-        img_analyse = imageio.imread(path_analyse, format='JPEG-PIL', pilmode='L')
-
-        # Convert images to int16 to allow negative values so that the negative values (background) can be filtered.
-        img_analyse = np.int16(img_analyse) - np.int16(img_background) * 2
-        for x, y in zip(np.where(img_analyse < 5)[0], np.where(img_analyse < 5)[1]):
-            img_analyse[x, y] = 0
-
-        return np.uint8(img_analyse)
-
-    images = {x.replace('.', '_align.') for x in images}
-
-    img_background = imageio.imread(os.path.join('background', 'background_with_stripes.jpg'), pilmode='L')
-    # ‘L’ (8-bit pixels, black and white)
-
-    for path_analyse in images:
-        img_analyse_wo_bkgnd = remove_background(path_analyse, img_background)
-
-        file, ending = os.path.splitext(path_analyse)
-        imageio.imsave(file[:-6] + '_wo_bkgnd' + ending, img_analyse_wo_bkgnd, format='jpg')
-
-def detect_lines(images):
-    @time_dec
-    def detect_line(path_analyse, img_analyse):
-        # Followed code example on https://stackoverflow.com/questions/39752235/python-how-to-detect-vertical-and-horizontal-lines-in-an-image-with-houghlines-w
-        # Canny makes edges visible in the image
-        edges = cv2.Canny(image=img_analyse, threshold1=20, threshold2=40)
-        # Houghlines detects lines in the image
-        lines = cv2.HoughLinesP(edges, rho=1, theta=np.pi / 180, threshold=10, minLineLength=150, maxLineGap=80)
-
-        if lines is None:
-            return []
-
-        lines = lines.reshape(len(lines), 4).tolist()
-
-        return util.createLinesWithClass(lines, path_analyse.replace('_wo_bkgnd', ''))
-
-    # Start here
-    images = {x.replace('.', '_wo_bkgnd.') for x in images}
-
-    if is_zero_file('lines_unfiltered.csv'):
-        with open('lines_unfiltered.csv', 'a') as file_results:
-            file_results.write('filename,angle,length,p1_x,p1_y,p2_x,p2_y\n')
-
-    already_analysed = list(set(pandas.read_csv('lines_unfiltered.csv').filename))
-    images_wo_duplicates = [x for x in images if x not in already_analysed]
-
-    for path_analyse in images_wo_duplicates:
-        img_analyse = imageio.imread(path_analyse, pilmode='L')
-        lines = detect_line(path_analyse, img_analyse)
-        util.linesToDataFrame(lines).to_csv('lines_unfiltered.csv', mode='a', header=False, index=False)
-
-        img_analyse_lines = util.colorImageWithLines(lines, img_analyse)
-        file, ending = os.path.splitext(path_analyse)
-        imageio.imsave(file[:-9] + '_unfiltered_lines' + ending, img_analyse_lines, format='jpg')
-
-
-def filter_lines(images):
-    @time_dec
-    def filter_line(filename, df_unfiltered):
-        df_filename = df_unfiltered[df_unfiltered.filename == filename]
-
-        lines_filename = []
-        for _, data in df_filename.iterrows():
-            lines_filename.append(util.Line(int(data.p1_x), int(data.p1_y), int(data.p2_x), int(data.p2_y), data.filename))
-
-        lines_filtered = util.filterLines(lines_filename) # Maybe work directly in the dataframe from panda
-
-        return lines_filtered
-
-    if is_zero_file('lines_unfiltered.csv'):
-        print('The file lines_unfiltered.csv is empty. \nCall only_filter after only_detect.')
+import metrics
+from store import LineStore
+from align import Aligner
+import detectors
+import frames
+import codec
+import background
+from cache import StageCache, hash_file, stage_key
+import service
+import pipeline
+
+# Folders of the stores with the detected lines
+LINES_UNFILTERED = 'lines_unfiltered'
+LINES_FILTERED = 'lines_filtered'
+
+# Suffixes of the intermediate images, e.g. Nebelkammer_000_align.jpg
+INTERMEDIATE_SUFFIXES = ['_align', '_wo_bkgnd', '_unfiltered_lines', '_filtered_lines', '_result']
+
+def apply(func, arguments):
+    '''Calls func with the unpacked arguments, used by map_images.
+       The metrics recorded meanwhile are returned with the result, so that the main process can write them.'''
+    try:
+        result = func(*arguments)
+    except BaseException:
+        # The record of the failed image would otherwise be returned with the next image of this process
+        metrics.collect()
+        raise
+    return result, metrics.collect()
+
+# Options of the command line, set in every process by configure
+options = None
+
+def configure(args):
+    '''Makes the options of the command line available in the current process'''
+    global options
+    options = args
+    metrics.configure(args.profile)
+
+def map_images(func, args, *iterables):
+    '''Like map(func, *iterables), but spreads the calls over a pool of args.jobs processes.
+       The results are returned in the order of the input.'''
+    configure(args)
+    arguments = zip(*iterables)
+    with Pool(args.jobs, configure, (args,)) if args.jobs > 1 else contextlib.nullcontext() as p:
+        results = p.imap(functools.partial(apply, func), arguments) if p else map(functools.partial(apply, func), arguments)
+        for result, records in results:
+            metrics.emit(records)
+            yield result
+
+def background_path(name):
+    return os.path.join('background', name)
+
+@functools.lru_cache(maxsize=None)
+def load_background(path):
+    '''Loads a background image, only once per process'''
+    return read_image(path)
+
+@functools.lru_cache(maxsize=None)
+def load_prepared_background(path):
+    '''Loads a background and prepares it for util.subtractBackground, only once per process'''
+    return util.prepareBackground(load_background(path))
+
+@functools.lru_cache(maxsize=None)
+def load_background_model(model, path, window):
+    '''Creates the model of the background which is subtracted, it learns from the frames of this process'''
+    return background.create(model, load_background(path), window)
+
+@functools.lru_cache(maxsize=None)
+def load_roi(roi, threshold, path):
+    '''Returns the mask of the region of interest (0 or 255) and its bounding box as slices, None for --roi none.
+       auto excludes the pixels where the background is so bright that nothing is left after subtracting it.
+       A mask image (white is inside) or a rectangle X,Y,W,H restricts the region further.'''
+    if roi == 'none':
+        return None
+
+    mask = np.uint8(load_prepared_background(path) + threshold <= 255) * 255
+    if roi != 'auto':
+        if os.path.isfile(roi):
+            mask &= np.uint8(read_image(roi) > 127) * 255
+        else:
+            x, y, w, h = (int(value) for value in roi.split(','))
+            rectangle = np.zeros_like(mask)
+            rectangle[y:y + h, x:x + w] = 255
+            mask &= rectangle
+
+    x, y, w, h = cv2.boundingRect(mask)
+    return mask, (slice(y, y + h), slice(x, x + w))
+
+@functools.lru_cache(maxsize=None)
+def load_aligner(name):
+    '''Creates the Aligner for a background, its Fourier transforms are calculated only once per process'''
+    return Aligner(load_background(background_path(name)))
+
+@functools.lru_cache(maxsize=None)
+def _load_cache(path, size):
+    return StageCache(path, size * 2**20)
+
+def load_cache():
+    '''Returns the cache of the stages, None if it is disabled with --no_cache'''
+    if options.no_cache:
+        return None
+    return _load_cache(options.cache, options.cache_size)
+
+def stage_keys(image, in_memory=False):
+    '''Returns the cache keys of align, remove_background and detect_line for the image.
+       Each key depends on the key of the previous stage, so a changed parameter changes only the keys after it.
+       The stream mode detects the lines on the image in memory instead of the JPEG, so its lines get other keys.
+       The ema and median backgrounds depend on the frames before, so the stages after align are not cached then.'''
+    key_align = stage_key('align', [hash_image(image), hash_file(background_path('background.jpg'))],
+                          method=options.align, codec=options.codec, quality=options.jpeg_quality)
+    if options.background_model != 'static':
+        return key_align, None, None
+    key_wo_bkgnd = stage_key('remove_background', [key_align, hash_file(options.background)],
+                             threshold=options.threshold, roi=roi_key())
+    key_unfiltered = stage_key('detect_line', [key_wo_bkgnd], in_memory=in_memory, detector=options.detector,
+                               detector_downscale=options.detector_downscale, tile=options.tile, tile_overlap=options.tile_overlap, canny=options.canny, hough_threshold=options.hough_threshold,
+                               min_line_length=options.min_line_length, max_line_gap=options.max_line_gap,
+                               # The segments at the seams of the tiles are merged with the tolerance of the filter
+                               **({'angle_tolerance': options.angle_tolerance} if options.tile else {}))
+    return key_align, key_wo_bkgnd, key_unfiltered
+
+def hash_image(image):
+    '''Returns the hash of an image file or of the pixels of a frame of a stack'''
+    if frames.is_frame(image):
+        return frames.hash_frame(image, frame_shape())
+    return hash_file(image)
+
+def roi_key():
+    '''Returns the option --roi for the cache keys, with the hash of the mask image instead of its name'''
+    if os.path.isfile(options.roi):
+        return hash_file(options.roi)
+    return options.roi
+
+def filter_key(key_unfiltered):
+    '''Returns the cache key of filter_line for the lines with the key key_unfiltered'''
+    return stage_key('filter_line', [key_unfiltered], angle_tolerance=options.angle_tolerance)
+
+def preview_key(key):
+    '''Returns the cache key of the image with the lines, which depends also on the size and quality of the preview'''
+    return stage_key('preview', [key], scale=options.preview_scale, quality=options.preview_quality)
+
+def cached_file(key, path, write):
+    '''Calls write(path), unless the cache has the file for the key, then the file is copied from the cache'''
+    cache = load_cache()
+    if cache is None or key is None:
+        write(path)
+        return
+    ending = os.path.splitext(path)[1]
+    if cache.get_file(key, ending, path):
+        return
+    write(path)
+    cache.put_file(key, ending, path)
+
+def cached_lines(key, filename, path=None):
+    '''Returns the lines for the key from the cache and copies the image with the lines to path.
+       Returns None if the cache has not both.'''
+    cache = load_cache()
+    if cache is None or key is None:
+        return None
+    lines = cache.get_lines(key)
+    if lines is None or (path and not cache.get_file(preview_key(key), '.jpg', path)):
+        return None
+    # Images with the same content have the same key
+    lines.filenames = [filename]
+    return lines
+
+def cache_lines(key, lines, path=None):
+    '''Puts the lines and the image with the lines at path into the cache'''
+    cache = load_cache()
+    if cache is None or key is None:
+        return
+    cache.put_lines(key, lines)
+    if path:
+        cache.put_file(preview_key(key), '.jpg', path)
+
+def frame_shape():
+    return tuple(options.frame_shape)
+
+def read_image(path, factor=1):
+    '''Reads the image as grayscale with the codec --codec, reduced by factor 1, 2, 4 or 8'''
+    with metrics.timer('decode'):
+        # A frame of a stack is a view into the memory-mapped file, it is neither decoded nor copied
+        if frames.is_frame(path):
+            return codec.resize(frames.read_frame(path, frame_shape()), factor)
+        return codec.read(path, options.codec, factor)
+
+def write_image(path, image, quality=None):
+    with metrics.timer('encode'):
+        codec.write(path, image, options.codec, quality or options.jpeg_quality)
+
+def write_overlay(path, lines, image):
+    '''Writes the image with the lines, which is only looked at, reduced to --preview_scale, and returns it'''
+    overlay = util.colorImageWithLines(lines, image, options.preview_scale)
+    write_image(path, overlay, options.preview_quality)
+    return overlay
+
+def intermediate_path(image, suffix):
+    '''Returns the path of an intermediate file of the image, e.g. Nebelkammer_000_align.jpg'''
+    if frames.is_frame(image):
+        return frames.frame_path(image, suffix)
+    file, ending = os.path.splitext(image)
+    return file + suffix + ending
+
+def result_titles(lines_unfiltered, lines_filtered):
+    return ['Image to be analyzed', 'Removed background',
+            'Detected %d lines before filtering' % lines_unfiltered, 'Detected %d lines after filtering' % lines_filtered]
+
+def compose_result(panels, titles, scale):
+    '''Puts the images in a 2x2 grid, each below a white band with its title, like a figure with four subplots'''
+    height, width = panels[0].shape[:2]
+    size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    band = max(24, size[1] // 12)
+    thickness = max(1, band // 20)
+
+    # The result is in color, if one of the panels is, e.g. the images with the lines
+    color = any(panel.ndim == 3 for panel in panels)
+    tiles = []
+    for panel, title in zip(panels, titles):
+        tile = np.full((band + size[1], size[0]) + ((3,) if color else ()), 255, dtype=np.uint8)
+        panel = cv2.resize(panel, size, interpolation=cv2.INTER_AREA)
+        tile[band:] = cv2.cvtColor(panel, cv2.COLOR_GRAY2BGR) if color and panel.ndim == 2 else panel
+
+        # The font is as large as fits into the band and the width of the panel
+        (text_width, text_height), _ = cv2.getTextSize(title, cv2.FONT_HERSHEY_SIMPLEX, 1, thickness)
+        font_scale = min(band * 0.6 / text_height, size[0] * 0.95 / text_width)
+        (text_width, text_height), _ = cv2.getTextSize(title, cv2.FONT_HERSHEY_SIMPLEX, font_scale, thickness)
+        origin = ((size[0] - text_width) // 2, (band + text_height) // 2)
+        cv2.putText(tile, title, origin, cv2.FONT_HERSHEY_SIMPLEX, font_scale, 0, thickness, cv2.LINE_AA)
+        tiles.append(tile)
+
+    return np.vstack([np.hstack(tiles[:2]), np.hstack(tiles[2:])])
+
+@metrics.measure
+def plot_result_image(image, lines_unfiltered, lines_filtered, key):
+    cached_file(key, intermediate_path(image, '_result'),
+                lambda path: plot_result(image, lines_unfiltered, lines_filtered, path))
+
+def plot_result(image, lines_unfiltered, lines_filtered, path):
+    '''Writes the result image of the image and its intermediate images.
+       The images are reduced already while decoding, as far as the size of the result allows.'''
+    factor = codec.reduction(options.result_scale)
+    factor_preview = codec.reduction(options.result_scale / options.preview_scale)
+    panels = [read_image(image, factor), read_image(intermediate_path(image, '_wo_bkgnd'), factor)] + \
+             [read_image(intermediate_path(image, suffix), factor_preview) for suffix in ['_unfiltered_lines', '_filtered_lines']]
+    # compose_result resizes all panels to the size of the first one
+    write_image(path, compose_result(panels, result_titles(lines_unfiltered, lines_filtered), options.result_scale * factor),
+                options.preview_quality)
+
+def plot_result_images(images, args):
+    # The number of lines per image is in the index of the stores
+    store_unfiltered = LineStore(LINES_UNFILTERED)
+    store_filtered = LineStore(LINES_FILTERED)
+    counts_unfiltered = store_unfiltered.counts()
+    counts_filtered = store_filtered.counts()
+
+    counts_unfiltered = [counts_unfiltered.get(image, 0) for image in images]
+    counts_filtered = [counts_filtered.get(image, 0) for image in images]
+
+    # The result shows the images with the lines, so it changes only if the lines change
+    keys = [stage_key('plot_result', [store_unfiltered.key(image), store_filtered.key(image)], scale=options.result_scale,
+                      preview_scale=options.preview_scale, quality=options.preview_quality)
+            if store_unfiltered.key(image) and store_filtered.key(image) else None for image in images]
+
+    for _ in map_images(plot_result_image, args, images, counts_unfiltered, counts_filtered, keys):
+        pass
+
+@metrics.step
+def align(img_analyse):
+    '''Aligns the image to the background image, depending on the option --align'''
+    # Align img_analyse to img_background
+    # The images are shifted, twisted, scaled and distorted (3D)
+    # First tried to use opencv (https://www.learnopencv.com/image-alignment-ecc-in-opencv-c-python/), but got miserable results
+    # Found on github https://github.com/matejak/imreg_dft a pretty good library, but it is very slow.
+    # The fast variant does the same on a downsampled image with the transforms of the background calculated once.
+    if options.align == 'fast':
+        return load_aligner('background.jpg').align(img_analyse)
+
+    if options.align == 'exact':
+        # Imported only here, imreg_dft with scipy takes longer to import than the rest of the program
+        import imreg_dft as ird
+        # Install pyfftw for better performance.
+        img_analyse_aligned = ird.similarity(load_background(background_path('background.jpg')), img_analyse, numiter=3)['timg']
+        return np.uint8(np.clip(img_analyse_aligned, 0, 255))
+
+    return img_analyse
+
+@metrics.step
+def remove_background(img_analyse):
+    '''Removes the background with stripes from the aligned image, only inside the region of interest.
+       Afterwards the model of the background learns from the image, unless it is static.'''
+    model = load_background_model(options.background_model, options.background, options.background_window)
+    background = model.prepared()
+    roi = load_roi(options.roi, options.threshold, options.background)
+    if roi is None:
+        img_wo_bkgnd = util.subtractBackground(img_analyse, background, options.threshold)
+    else:
+        mask, box = roi
+        img_wo_bkgnd = np.zeros_like(img_analyse)
+        img_wo_bkgnd[box] = util.subtractBackground(img_analyse[box], background[box], options.threshold) & mask[box]
+    model.update(img_analyse)
+    return img_wo_bkgnd
+
+@metrics.step
+def detect_line(img_analyse, filename):
+    '''Detects the lines in the image without background with the detector chosen by --detector'''
+    roi = load_roi(options.roi, options.threshold, options.background)
+    return util.LineSet.fromPoints(detectors.detect(img_analyse, options, roi and roi[1]), filename)
+
+@metrics.step
+def filter_line(lines):
+    '''Connects the duplicate lines'''
+    return util.filterLines(lines, options.angle_tolerance)
+
+@metrics.measure
+def align_file(image):
+    key_align, _, _ = stage_keys(image)
+    cached_file(key_align, intermediate_path(image, '_align'), lambda path: write_image(path, align(read_image(image))))
+
+def align_images(images, args):
+    for _ in map_images(align_file, args, images):
+        pass
+
+@metrics.measure
+def remove_background_file(image):
+    _, key_wo_bkgnd, _ = stage_keys(image)
+    cached_file(key_wo_bkgnd, intermediate_path(image, '_wo_bkgnd'),
+                lambda path: write_image(path, remove_background(read_image(intermediate_path(image, '_align')))))
+
+def remove_backgrounds(images, args):
+    for _ in map_images(remove_background_file, args, images):
+        pass
+
+@metrics.measure
+def detect_line_file(image, key_stored):
+    '''Returns the key and the lines of the image, the lines are None if the store has them already'''
+    _, _, key = stage_keys(image)
+    path = intermediate_path(image, '_unfiltered_lines')
+    if key and key == key_stored and os.path.isfile(path):
+        return key, None
+
+    lines = cached_lines(key, image, path)
+    if lines is None:
+        img_analyse = read_image(intermediate_path(image, '_wo_bkgnd'))
+        lines = detect_line(img_analyse, image)
+        write_overlay(path, lines, img_analyse)
+        cache_lines(key, lines, path)
+    metrics.annotate(lines_unfiltered=len(lines))
+
+    return key, lines
+
+def detect_lines(images, args):
+    store_unfiltered = LineStore(LINES_UNFILTERED)
+    keys_stored = [store_unfiltered.key(x) for x in images]
+
+    # The lines are appended in the order of the images, no matter which process finishes first
+    for image, (key, lines) in zip(images, map_images(detect_line_file, args, images, keys_stored)):
+        if lines is not None:
+            store_unfiltered.append(lines, {image: key})
+
+@metrics.measure
+def filter_line_file(filename, lines_filename, key_unfiltered, key_stored):
+    '''Returns the key and the filtered lines of the image, the lines are None if the store has them already.
+       The key is None for lines in the store without key, then nothing is cached.'''
+    key = filter_key(key_unfiltered) if key_unfiltered else None
+    path = intermediate_path(filename, '_filtered_lines')
+    if key and key == key_stored and os.path.isfile(path):
+        return key, None
+
+    lines_filtered = cached_lines(key, filename, path)
+    if lines_filtered is None:
+        lines_filtered = filter_line(lines_filename)
+        img_analyse = read_image(intermediate_path(filename, '_wo_bkgnd'))
+        write_overlay(path, lines_filtered, img_analyse)
+        cache_lines(key, lines_filtered, path)
+    metrics.annotate(lines_unfiltered=len(lines_filename), lines_filtered=len(lines_filtered))
+
+    return key, lines_filtered
+
+def filter_lines(images, args):
+    store_unfiltered = LineStore(LINES_UNFILTERED)
+    filenames = [x for x in images if x in store_unfiltered]
+    if not filenames:
+        print('The images are not in the store ' + LINES_UNFILTERED + '. \nCall only_filter after only_detect.')
         return
 
-    with open('lines_filtered.csv', 'w') as file_results:
-        file_results.write('filename,angle,length,p1_x,p1_y,p2_x,p2_y\n')
-
-    df_unfiltered = pandas.read_csv('lines_unfiltered.csv')
-
-    filenames = set(df_unfiltered.filename)
-
-    for filename in filenames:
-        lines_filtered = filter_line(filename, df_unfiltered)
-        util.linesToDataFrame(lines_filtered).to_csv('lines_filtered.csv', mode='a', header=False, index=False)
-
-        file, ending = os.path.splitext(filename)
-        img_analyse = imageio.imread(file + '_wo_bkgnd' + ending, pilmode='L')
-        img_analyse_lines = util.colorImageWithLines(lines_filtered, img_analyse)
-
-        imageio.imsave(file + '_filtered_lines' + ending, img_analyse_lines, format='jpg')
-
-def complete(images):
-    align_images(images)
-    remove_backgrounds(images)
-    detect_lines(images)
-    filter_lines(images)
-    plot_result_images(images)
-
-def main():
+    # Only the chunks of these images are read, the lines of each image replace earlier filtered lines
+    lines_by_filename = store_unfiltered.read(filenames).splitByFilename()
+    store_filtered = LineStore(LINES_FILTERED)
+    keys_unfiltered = [store_unfiltered.key(x) for x in filenames]
+    keys_stored = [store_filtered.key(x) for x in filenames]
+
+    results = map_images(filter_line_file, args, filenames, lines_by_filename, keys_unfiltered, keys_stored)
+    for filename, (key, lines_filtered) in zip(filenames, results):
+        if lines_filtered is not None:
+            store_filtered.append(lines_filtered, {filename: key} if key else None)
+
+def complete(images, args):
+    align_images(images, args)
+    remove_backgrounds(images, args)
+    detect_lines(images, args)
+    filter_lines(images, args)
+    plot_result_images(images, args)
+
+@metrics.measure
+def process_image(image, key_unfiltered_stored, key_filtered_stored):
+    '''Runs all steps for one image in memory, the image is decoded only once.
+       Returns the keys and the lines, the lines are None if the stores have them already.
+       Only the lines are cached, the images are not.'''
+    _, _, key_unfiltered = stage_keys(image, in_memory=True)
+    key_filtered = filter_key(key_unfiltered) if key_unfiltered else None
+    # With --debug_images the image is only skipped if its intermediate images were written as well
+    if key_unfiltered and (key_unfiltered, key_filtered) == (key_unfiltered_stored, key_filtered_stored) and \
+       (not options.debug_images or all(os.path.isfile(intermediate_path(image, suffix)) for suffix in INTERMEDIATE_SUFFIXES)):
+        return key_unfiltered, key_filtered, None, None
+
+    lines_unfiltered = cached_lines(key_unfiltered, image)
+    lines_filtered = cached_lines(key_filtered, image)
+
+    if lines_unfiltered is None or options.debug_images:
+        img_analyse = read_image(image)
+        img_aligned = align(img_analyse)
+        img_wo_bkgnd = remove_background(img_aligned)
+        lines_unfiltered = detect_line(img_wo_bkgnd, image)
+        cache_lines(key_unfiltered, lines_unfiltered)
+
+    if lines_filtered is None or options.debug_images:
+        lines_filtered = filter_line(lines_unfiltered)
+        cache_lines(key_filtered, lines_filtered)
+    metrics.annotate(lines_unfiltered=len(lines_unfiltered), lines_filtered=len(lines_filtered))
+
+    if options.debug_images:
+        write_image(intermediate_path(image, '_align'), img_aligned)
+        write_image(intermediate_path(image, '_wo_bkgnd'), img_wo_bkgnd)
+        img_unfiltered_lines = write_overlay(intermediate_path(image, '_unfiltered_lines'), lines_unfiltered, img_wo_bkgnd)
+        img_filtered_lines = write_overlay(intermediate_path(image, '_filtered_lines'), lines_filtered, img_wo_bkgnd)
+        # The result is composed from the images in memory, so they are not decoded again
+        write_image(intermediate_path(image, '_result'),
+                    compose_result([img_analyse, img_wo_bkgnd, img_unfiltered_lines, img_filtered_lines],
+                                   result_titles(len(lines_unfiltered), len(lines_filtered)), options.result_scale),
+                    options.preview_quality)
+
+    return key_unfiltered, key_filtered, lines_unfiltered, lines_filtered
+
+def read_ahead(image):
+    '''Reads the file of the image into the page cache of the system, so that decoding it does not wait for the disk.
+       The bytes are not kept, the process which analyses the image reads them again from memory.'''
+    if frames.is_frame(image):
+        # Frames of TIFF stacks without tifffile would be decoded twice, so only the memory-mapped ones are read
+        if frames.parse_frame(image)[0].endswith(('.npy', '.raw')):
+            frames.read_frame(image, frame_shape()).max()
+        return
+    with open(image, 'rb') as file:
+        while file.read(1 << 20):
+            pass
+
+def stream(images, args):
+    '''Processes every image in one pass without intermediate files, only the lines are written.
+       With --debug_images the intermediate images and the result images are written as well.
+       Reading, analysing and writing overlap, see pipeline.py: args.readers threads read the images ahead and a
+       thread appends the lines of up to args.write_batch finished images as one chunk to the stores.'''
+    store_unfiltered = LineStore(LINES_UNFILTERED)
+    store_filtered = LineStore(LINES_FILTERED)
+    keys = {image: (store_unfiltered.key(image), store_filtered.key(image)) for image in images}
+
+    def write(results):
+        lines_unfiltered, lines_filtered, keys_unfiltered, keys_filtered = [], [], {}, {}
+        for image, ((key_unfiltered, key_filtered, lines_image_unfiltered, lines_image_filtered), records) in results:
+            metrics.emit(records)
+            if lines_image_unfiltered is None:
+                continue
+            lines_unfiltered.append(lines_image_unfiltered)
+            lines_filtered.append(lines_image_filtered)
+            keys_unfiltered[image] = key_unfiltered
+            keys_filtered[image] = key_filtered
+        if lines_unfiltered:
+            store_unfiltered.append(util.LineSet.concatenate(lines_unfiltered), keys_unfiltered)
+            store_filtered.append(util.LineSet.concatenate(lines_filtered), keys_filtered)
+
+    configure(args)
+    # Without a pool a single thread analyses the images, so that the main thread can keep the readers busy
+    with Pool(args.jobs, configure, (args,)) if args.jobs > 1 else ThreadPoolExecutor(1) as p:
+        if args.jobs > 1:
+            submit = lambda image: p.apply_async(apply, (process_image, (image,) + keys[image])).get
+        else:
+            submit = lambda image: p.submit(apply, process_image, (image,) + keys[image]).result
+        pipeline.run(images, read_ahead, submit, write, args.readers, 2 * max(args.jobs, 1), args.write_batch)
+
+def configure_watch(args):
+    '''Like configure, Ctrl+C is ignored, so that the main process can finish the images in progress'''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    configure(args)
+
+def is_intermediate(image):
+    return os.path.splitext(image)[0].endswith(tuple(INTERMEDIATE_SUFFIXES))
+
+def new_frames(directory, seen, sizes):
+    '''Returns the new images in the folder, which are complete.
+       An image is complete, if its size did not change since the last call, sizes is updated for the next call.'''
+    frames = []
+    for name in sorted(util.listImages(directory)):
+        image = os.path.join(directory, name)
+        if image in seen or is_intermediate(image):
+            continue
+        try:
+            size = os.path.getsize(image)
+        except FileNotFoundError:
+            continue
+        if size and sizes.get(image) == size:
+            frames.append(image)
+        sizes[image] = size
+    return frames
+
+def watch(images, args):
+    '''Processes new images in the folder args.watch as they arrive, like stream, until Ctrl+C is pressed.
+       At most 2 * args.jobs images are in progress, further images wait in the folder meanwhile.
+       Images already in the stores are not processed again, so the watch can be restarted after an interruption.'''
+    store_unfiltered = LineStore(LINES_UNFILTERED)
+    store_filtered = LineStore(LINES_FILTERED)
+    max_pending = 2 * max(args.jobs, 1)
+
+    seen = set(x for x in store_filtered.filenames() if x in store_unfiltered)
+    sizes = {}
+    queue = collections.deque(x for x in images if x not in seen)
+    seen.update(queue)
+    pending = collections.deque()
+    last_frame = time.time()
+
+    def finish_oldest():
+        # The lines are appended in the order the images arrived
+        image, result = pending.popleft()
+        (key_unfiltered, key_filtered, lines_unfiltered, lines_filtered), records = result.get()
+        metrics.emit(records)
+        if lines_unfiltered is not None:
+            store_unfiltered.append(lines_unfiltered, {image: key_unfiltered})
+            store_filtered.append(lines_filtered, {image: key_filtered})
+
+    configure(args)
+    print('Watching', args.watch, flush=True)
+    with Pool(max(args.jobs, 1), configure_watch, (args,)) as p:
+        try:
+            while True:
+                while pending and pending[0][1].ready():
+                    finish_oldest()
+
+                if len(pending) < max_pending and not queue:
+                    frames = new_frames(args.watch, seen, sizes)
+                    seen.update(frames)
+                    queue.extend(frames)
+                    if frames:
+                        last_frame = time.time()
+                    elif args.watch_timeout is not None and not pending and time.time() - last_frame > args.watch_timeout:
+                        break
+
+                # Backpressure: new images are only taken, if fewer than max_pending are in progress
+                while queue and len(pending) < max_pending:
+                    image = queue.popleft()
+                    pending.append((image, p.apply_async(apply, (process_image, (image, store_unfiltered.key(image), store_filtered.key(image))))))
+
+                if pending:
+                    pending[0][1].wait(None if len(pending) >= max_pending else args.poll)
+                else:
+                    time.sleep(args.poll)
+        except KeyboardInterrupt:
+            print('Finishing the images in progress', flush=True)
+
+        while pending:
+            finish_oldest()
+
+def serve(images, args):
+    '''Analyses the images sent to the Unix socket args.serve like stream, until Ctrl+C is pressed, see service.py.
+       The processes stay alive, so the backgrounds, the aligners and the modules are loaded only once.
+       Images already in the stores are answered from the stores.'''
+    store_unfiltered = LineStore(LINES_UNFILTERED)
+    store_filtered = LineStore(LINES_FILTERED)
+    lock = threading.Lock()  # The stores and the counters are shared by the threads of the connections
+    started = time.time()
+    finished = collections.deque()  # Times at which the images of the last minute were finished
+    frames_finished = 0
+    pending = 0
+
+    def analyse(images):
+        nonlocal pending, frames_finished
+        with lock:
+            results = [(image, p.apply_async(apply, (process_image, (image, store_unfiltered.key(image), store_filtered.key(image)))))
+                       for image in images]
+            pending += len(images)
+
+        answers = []
+        for image, result in results:
+            try:
+                (key_unfiltered, key_filtered, lines_unfiltered, lines_filtered), records = result.get()
+                error = None
+            except Exception as exception:
+                error = str(exception)  # E.g. the image does not exist
+
+            with lock:
+                pending -= 1
+                frames_finished += 1
+                finished.append(time.time())
+                if error is None:
+                    metrics.emit(records)
+                    if lines_unfiltered is not None:
+                        store_unfiltered.append(lines_unfiltered, {image: key_unfiltered})
+                        store_filtered.append(lines_filtered, {image: key_filtered})
+                    else:
+                        lines_filtered = store_filtered.read([image])
+            answers.append({'image': image, 'error': error} if error else {'image': image, 'lines': lines_filtered.points.tolist()})
+        return answers
+
+    def respond(request):
+        if 'images' in request:
+            return {'results': analyse(request['images'])}
+        with lock:
+            now = time.time()
+            while finished and now - finished[0] > 60:
+                finished.popleft()
+            return {'pending': pending, 'frames': frames_finished, 'seconds': now - started,
+                    'frames_per_second': frames_finished / (now - started),
+                    'frames_per_second_last_minute': len(finished) / min(60, now - started)}
+
+    configure(args)
+    with Pool(max(args.jobs, 1), configure_watch, (args,)) as p:
+        with service.Server(args.serve, respond) as server:
+            print('Serving on', args.serve, flush=True)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+
+def parse_args(argv=None):
     parser = ArgumentParser(prog="Cloudchamber", description="Automatic line detection for the cloud chamber")
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-c', '--complete', action='store_const', dest='type', help='execute the complete program, be careful, takes time', const=complete)
+    group.add_argument('-s', '--stream', action='store_const', dest='type', help='execute the complete program in memory, only the lines are saved', const=stream)
     group.add_argument('-a', '--only_align', action='store_const', dest='type', help='align images to the background image', const=align_images)
     group.add_argument('-b', '--only_back', action='store_const', dest='type', help='remove the backgrounds in the images', const=remove_backgrounds)
     group.add_argument('-d', '--only_detect', action='store_const', dest='type', help='detect lines in the images', const=detect_lines)
     group.add_argument('-f', '--only_filter', action='store_const', dest='type', help='filter duplicate lines.', const=filter_lines)
     group.add_argument('-p', '--only_plot', action='store_const', dest='type', help='plot the results.', const=plot_result_images)
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N', help='number of processes that work on the images in parallel')
+    parser.add_argument('--readers', type=int, default=2, metavar='N', help='number of threads that read the images ahead in the stream mode')
+    parser.add_argument('--write_batch', type=int, default=16, metavar='IMAGES',
+                        help='maximal number of images whose lines are appended to the stores at once in the stream mode')
+    parser.add_argument('--debug_images', action='store_true', help='also save the intermediate images in the stream mode')
+    parser.add_argument('--align', choices=['fast', 'exact', 'none'], default='fast',
+                        help='fast: phase correlation on downsampled images (default), exact: imreg_dft at full resolution, very slow, none: no alignment')
+    parser.add_argument('--codec', choices=['auto'] + sorted(codec.CODECS), default='auto',
+                        help='library which reads and writes the images, auto: turbojpeg if PyTurboJPEG is installed, else opencv')
+    parser.add_argument('--jpeg_quality', type=int, default=75, metavar='QUALITY', help='JPEG quality of the intermediate images which are analysed further')
+    parser.add_argument('--preview_scale', type=float, default=0.5, help='size of the images with the lines relative to the original')
+    parser.add_argument('--preview_quality', type=int, default=75, metavar='QUALITY', help='JPEG quality of the images with the lines and the result images')
+    parser.add_argument('--result_scale', type=float, default=0.5, help='size of the images in the result image relative to the original')
+    parser.add_argument('--threshold', type=int, default=5, help='pixels below this value after subtracting the background are set to zero')
+    parser.add_argument('--frames', type=frames.parse_range, default=slice(None), metavar='START:STOP',
+                        help='range of the frames of the stacks (.npy, .raw, .tif) to be analysed, e.g. 10:50, all frames by default')
+    parser.add_argument('--frame_shape', type=int, nargs=2, default=[3072, 4608], metavar=('HEIGHT', 'WIDTH'),
+                        help='height and width of the frames of raw stacks, which have no header')
+    parser.add_argument('--background', default=background_path('background_with_stripes.jpg'), metavar='FILE',
+                        help='background which is subtracted, e.g. one per session, background/background_with_stripes.jpg by default')
+    parser.add_argument('--background_model', choices=sorted(background.MODELS), default='static',
+                        help='static: subtract the background (default), ema: moving average and median: running median of the frames, '
+                        'both start with the background and follow the changes of the lighting during a run')
+    parser.add_argument('--background_window', type=int, default=100, metavar='FRAMES', help='number of frames averaged by the ema background')
+    parser.add_argument('--roi', default='none', help='region of interest: none (default), auto: without the pixels where the background '
+                        'is too bright for tracks, a mask image (white is inside) or a rectangle X,Y,W,H, both combined with auto')
+    parser.add_argument('--tile', type=int, default=0, metavar='SIZE', help='detect the lines in tiles of SIZE x SIZE pixels, black tiles are skipped')
+    parser.add_argument('--tile_overlap', type=int, default=16, metavar='PIXELS', help='overlap of the tiles, segments crossing a seam are merged')
+    parser.add_argument('--tile_threads', type=int, default=1, metavar='N', help='number of threads that detect the lines in the tiles')
+    parser.add_argument('--detector', choices=sorted(detectors.DETECTORS), default='hough',
+                        help='hough: Canny and Hough on the full image (default), lsd: Line Segment Detector on the downsampled image, '
+                        'coarse_hough: Hough on the downsampled image, refined at full resolution around the found lines')
+    parser.add_argument('--detector_downscale', type=int, default=4, metavar='FACTOR', help='downsampling of the image for lsd and coarse_hough')
+    parser.add_argument('--canny', type=int, nargs=2, default=[20, 40], metavar=('LOW', 'HIGH'), help='thresholds of the Canny edge detection')
+    parser.add_argument('--hough_threshold', type=int, default=10, help='minimal number of votes of a line in the Hough transform')
+    parser.add_argument('--min_line_length', type=int, default=150, help='minimal length of a detected line in pixels')
+    parser.add_argument('--max_line_gap', type=int, default=80, help='maximal gap between two points of the same line in pixels')
+    parser.add_argument('--angle_tolerance', type=float, default=10, help='maximal difference of the angles of lines that are merged in degree')
+    parser.add_argument('--cache', default='cache', metavar='DIR', help='folder of the cache of the stages')
+    parser.add_argument('--cache_size', type=int, default=2000, metavar='MB', help='maximal size of the cache, the least recently used entries are removed')
+    parser.add_argument('--no_cache', action='store_true', help='neither use nor fill the cache')
+    parser.add_argument('-w', '--watch', metavar='DIR', help='process new images in the folder as they arrive, in memory like --stream, until Ctrl+C')
+    parser.add_argument('--poll', type=float, default=1, metavar='SECONDS', help='interval in which the folder of --watch is checked for new images')
+    parser.add_argument('--watch_timeout', type=float, metavar='SECONDS', help='stop watching, when no new image arrived for this time')
+    parser.add_argument('--serve', metavar='SOCKET', help='keep running and analyse the images sent to the Unix socket, '
+                        'in memory like --stream, until Ctrl+C, see service.py')
+    parser.add_argument('--metrics', metavar='FILE', help='write the times, the number of lines and the memory per image and stage to FILE, '
+                        'as Prometheus textfile if it ends with .prom, else as JSON lines')
+    parser.add_argument('--profile', metavar='NAME', help='profile a stage or step with cProfile, e.g. detect_line, '
+                        'the statistics are saved as profile_NAME_PID.prof')
     parser.add_argument('-v', '--version', action='version', version='%(prog)s 1.0')
-    parser.add_argument('images', metavar='images', type=str, nargs='+', help='images to be analysed')
+    parser.add_argument('images', metavar='images', type=str, nargs='*', help='images or stacks of frames to be analysed')
     parser.set_defaults(type=complete)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    try:
+        args.codec = codec.resolve(args.codec)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.watch:
+        args.type = watch
+    elif args.serve:
+        args.type = serve
+    elif not args.images:
+        parser.error('the following arguments are required: images')
+    return args
+
+def main():
+    args = parse_args()
+    configure(args)
+    if args.metrics:
+        metrics.open_sink(args.metrics)
 
     # Call function depending on cli argument
-    images = {x.replace('_align', '').replace('_wo_bkgnd', '').replace('_unfiltered_lines', '').replace('_filtered_lines', '').replace('_result', '')  for x in args.images}
-    args.type(sorted(images))
+    images = set(x for x in args.images if not frames.is_stack(x))
+    for suffix in INTERMEDIATE_SUFFIXES:
+        images = {x.replace(suffix, '') for x in images}
+    # The stacks are given by their file, the frames in the range --frames are analysed
+    for stack in (x for x in args.images if frames.is_stack(x)):
+        images.update(frames.frame_names(stack, args.frames, frame_shape()))
+    try:
+        args.type(sorted(images), args)
+    finally:
+        metrics.close_sink()
+
+    cache = load_cache()
+    if cache:
+        cache.evict()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,106 @@
+'''Reading and writing of the grayscale images with different libraries.
+
+Every codec has a function which reads an image reduced by a factor 1, 2, 4 or 8 and a function which writes a JPEG
+with a quality. OpenCV and libjpeg-turbo reduce JPEGs already while decoding, by scaling the DCT blocks, which is
+much faster than decoding the full image and resizing it. New codecs are added to CODECS.'''
+import numpy as np
+import cv2
+try:
+    import turbojpeg
+except ImportError:
+    turbojpeg = None  # Optional, pip install PyTurboJPEG
+
+REDUCED_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+def reduction(scale):
+    '''Returns the largest factor of REDUCED_FLAGS by which an image can be reduced, before it is resized to scale'''
+    return max((factor for factor in REDUCED_FLAGS if factor * scale <= 1), default=1)
+
+def resize(image, factor):
+    '''Reduces the image by the factor, like the reduced decoding of OpenCV'''
+    if factor == 1:
+        return image
+    height, width = image.shape[:2]
+    size = (-(-width // factor), -(-height // factor))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+def is_jpeg(path):
+    return path.lower().endswith(('.jpg', '.jpeg'))
+
+def read_imageio(path, factor=1):
+    # Imported only for this codec, newer than 2.2.0 must be used to use pilmode e.g. pip install git+https://github.com/imageio/imageio.git
+    import imageio
+    # ‘L’ (8-bit pixels, black and white)
+    return resize(imageio.imread(path, pilmode='L'), factor)
+
+def write_imageio(path, image, quality):
+    import imageio
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)  # imageio expects RGB, OpenCV uses BGR
+    imageio.imsave(path, image, format='jpg', quality=quality)
+
+def read_opencv(path, factor=1):
+    image = cv2.imread(path, REDUCED_FLAGS[factor])
+    if image is None:
+        raise IOError('Cannot read the image ' + path)
+    return image
+
+def write_opencv(path, image, quality):
+    if not cv2.imwrite(path, image, [cv2.IMWRITE_JPEG_QUALITY, quality]):
+        raise IOError('Cannot write the image ' + path)
+
+def read_turbojpeg(path, factor=1):
+    if not is_jpeg(path):
+        return read_opencv(path, factor)
+    with open(path, 'rb') as file:
+        data = file.read()
+    image = load_turbojpeg().decode(data, pixel_format=turbojpeg.TJPF_GRAY, scaling_factor=(1, factor))
+    return image.reshape(image.shape[:2])
+
+def write_turbojpeg(path, image, quality):
+    if not is_jpeg(path):
+        return write_opencv(path, image, quality)
+    if image.ndim == 3:
+        # The images with the lines are in color
+        data = load_turbojpeg().encode(image, quality=quality, pixel_format=turbojpeg.TJPF_BGR)
+    else:
+        data = load_turbojpeg().encode(image[:, :, np.newaxis], quality=quality, pixel_format=turbojpeg.TJPF_GRAY, jpeg_subsample=turbojpeg.TJSAMP_GRAY)
+    with open(path, 'wb') as file:
+        file.write(data)
+
+_turbojpeg = None
+
+def load_turbojpeg():
+    '''Loads libjpeg-turbo only once per process'''
+    global _turbojpeg
+    _turbojpeg = _turbojpeg or turbojpeg.TurboJPEG()
+    return _turbojpeg
+
+CODECS = {
+    'imageio': (read_imageio, write_imageio),
+    'opencv': (read_opencv, write_opencv),
+    'turbojpeg': (read_turbojpeg, write_turbojpeg),
+}
+
+def available():
+    '''Returns the names of the codecs whose libraries are installed'''
+    return [name for name in CODECS if name != 'turbojpeg' or turbojpeg is not None]
+
+def resolve(name):
+    '''Returns the codec for the option --codec, auto is turbojpeg if it is installed, else opencv'''
+    if name == 'auto':
+        return 'turbojpeg' if turbojpeg is not None else 'opencv'
+    if name not in available():
+        raise ValueError('The codec %s is not installed' % name)
+    return name
+
+def read(path, codec='opencv', factor=1):
+    return CODECS[codec][0](path, factor)
+
+def write(path, image, codec='opencv', quality=75):
+    CODECS[codec][1](path, image, quality)
@@ -0,0 +1,136 @@
+'''Line detectors, which find the tracks in an image without background.
+
+Every detector is called with the image and the options of the command line and returns the points of the
+segments as array with one row x1, y1, x2, y2 per segment. New detectors are added to DETECTORS.
+detect runs the chosen detector on the region of interest, optionally in tiles.'''
+import numpy as np
+import cv2
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import util  # Selfmade library
+
+def as_points(lines):
+    '''Returns the points of cv2.HoughLinesP or cv2.LineSegmentDetector as int32 array with four columns'''
+    if lines is None:
+        return np.zeros((0, 4), dtype=np.int32)
+    return np.rint(lines.reshape(-1, 4)).astype(np.int32)
+
+def max_pool(image, factor):
+    '''Downsamples the image by taking the maximum of factor x factor pixels, so that thin tracks are kept'''
+    if factor <= 1:
+        return image
+    dilated = cv2.dilate(image, np.ones((factor, factor), dtype=np.uint8), anchor=(0, 0))
+    return np.ascontiguousarray(dilated[::factor, ::factor])
+
+def canny(image, options):
+    '''Canny makes edges visible in the image'''
+    return cv2.Canny(image=image, threshold1=options.canny[0], threshold2=options.canny[1])
+
+def hough_lines(edges, options):
+    '''Houghlines detects lines in the image of the edges'''
+    lines = cv2.HoughLinesP(edges, rho=1, theta=np.pi / 180, threshold=options.hough_threshold,
+                            minLineLength=options.min_line_length, maxLineGap=options.max_line_gap)
+    return as_points(lines)
+
+def hough(image, options):
+    '''Canny edge detection followed by the probabilistic Hough transform on the full image'''
+    # Followed code example on https://stackoverflow.com/questions/39752235/python-how-to-detect-vertical-and-horizontal-lines-in-an-image-with-houghlines-w
+    return hough_lines(canny(image, options), options)
+
+@functools.lru_cache(maxsize=None)
+def line_segment_detector():
+    return cv2.createLineSegmentDetector()
+
+def lsd(image, options):
+    '''Line Segment Detector of OpenCV on the image downsampled by options.detector_downscale.
+       It needs no thresholds, but only segments of at least options.min_line_length are kept.'''
+    factor = max(options.detector_downscale, 1)
+    lines = line_segment_detector().detect(max_pool(image, factor))[0]
+    # A pixel of the small image is the centre of factor x factor pixels
+    points = as_points(None if lines is None else lines * factor + (factor - 1) / 2)
+    lengths = np.hypot(points[:, 2] - points[:, 0], points[:, 3] - points[:, 1])
+    return points[lengths >= options.min_line_length]
+
+def coarse_hough(image, options):
+    '''Hough on the image downsampled by options.detector_downscale, which finds the regions with tracks.
+       Only these regions are searched again with hough at full resolution.'''
+    factor = max(options.detector_downscale, 1)
+    small = max_pool(image, factor)
+    edges = canny(small, options)
+    coarse = as_points(cv2.HoughLinesP(edges, rho=1, theta=np.pi / 180, threshold=options.hough_threshold,
+                                       minLineLength=options.min_line_length / factor, maxLineGap=options.max_line_gap / factor))
+    if not len(coarse):
+        return coarse
+
+    # Regions of connected coarse segments, each searched once
+    mask = np.zeros(small.shape, dtype=np.uint8)
+    cv2.polylines(mask, coarse.reshape(-1, 2, 2), False, 255, thickness=3)
+    _, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+
+    height, width = image.shape
+    margin = 2 * factor
+    points = []
+    for x, y, w, h, _ in stats[1:]:
+        x1, y1 = max(0, x * factor - margin), max(0, y * factor - margin)
+        x2, y2 = min(width, (x + w) * factor + margin), min(height, (y + h) * factor + margin)
+        points.append(hough(image[y1:y2, x1:x2], options) + np.array([x1, y1, x1, y1], dtype=np.int32))
+    return np.concatenate(points)
+
+DETECTORS = {
+    'hough': hough,
+    'lsd': lsd,
+    'coarse_hough': coarse_hough,
+}
+
+def tiles(shape, size, overlap):
+    '''Returns the slices of the tiles of size x size pixels, each enlarged by overlap pixels on every side'''
+    height, width = shape
+    return [(slice(max(0, y - overlap), min(height, y + size + overlap)), slice(max(0, x - overlap), min(width, x + size + overlap)))
+            for y in range(0, height, size) for x in range(0, width, size)]
+
+def near_seam(points, shape, size, overlap):
+    '''Returns which segments have an end point within overlap pixels of a seam between two tiles'''
+    near = np.zeros(len(points), dtype=bool)
+    for axis, length in [(0, shape[1]), (1, shape[0])]:
+        coordinates = points[:, [axis, axis + 2]]
+        distance = np.minimum(coordinates % size, size - coordinates % size)
+        # The borders of the image are no seams
+        inside = (coordinates > overlap) & (coordinates < length - overlap)
+        near |= ((distance <= overlap) & inside).any(axis=1)
+    return near
+
+@functools.lru_cache(maxsize=None)
+def thread_pool(threads):
+    return ThreadPoolExecutor(threads)
+
+def detect_tiled(detector, image, options):
+    '''Runs the detector on every tile that is not completely black, the tiles can be processed in threads.
+       A segment crossing a seam is found in both tiles, as the tiles overlap, and merged with filterLines.'''
+    size, overlap = options.tile, options.tile_overlap
+    # Black tiles have no edges, so the time scales with the area which has tracks
+    active = [box for box in tiles(image.shape, size, overlap) if cv2.countNonZero(image[box])]
+
+    def detect_tile(box):
+        offset = np.array([box[1].start, box[0].start] * 2, dtype=np.int32)
+        return detector(np.ascontiguousarray(image[box]), options) + offset
+
+    if options.tile_threads > 1:
+        points = list(thread_pool(options.tile_threads).map(detect_tile, active))
+    else:
+        points = [detect_tile(box) for box in active]
+    points = np.concatenate(points) if points else as_points(None)
+
+    near = near_seam(points, image.shape, size, overlap)
+    merged = util.filterLines(util.LineSet.fromPoints(points[near], ''), options.angle_tolerance)
+    return np.concatenate([points[~near], merged.points])
+
+def detect(image, options, box=None):
+    '''Runs the detector options.detector on the region box of the image, in tiles if options.tile is set'''
+    detector = DETECTORS[options.detector]
+    if box is not None:
+        offset = np.array([box[1].start, box[0].start] * 2, dtype=np.int32)
+        return detect(np.ascontiguousarray(image[box]), options) + offset
+    if options.tile:
+        return detect_tiled(detector, image, options)
+    return detector(image, options)
@@ -0,0 +1,102 @@
+'''Stacks of frames, which hold many frames of the camera in one file: NPY, raw 8-bit and multi-frame TIFF.
+
+NPY and raw stacks are memory-mapped, so a frame is only read from the disk when it is used and it is handed to the
+steps as a view without copying it. A frame is named after its stack and its index, e.g. run.npy:000042, so that it
+is stored in the LineStore and the cache like an image.'''
+import os
+import hashlib
+import functools
+import numpy as np
+import cv2
+try:
+    import tifffile
+except ImportError:
+    tifffile = None  # Multi-frame TIFFs are read with OpenCV then, one frame after the other
+
+STACK_ENDINGS = ('.npy', '.raw', '.tif', '.tiff')
+
+def is_stack(path):
+    return path.lower().endswith(STACK_ENDINGS)
+
+def frame_name(stack, index):
+    return '%s:%06d' % (stack, index)
+
+def parse_frame(name):
+    '''Returns the stack and the index of a frame name like run.npy:000042, None if it is no frame'''
+    stack, separator, index = name.rpartition(':')
+    if separator and index.isdigit() and is_stack(stack):
+        return stack, int(index)
+    return None
+
+def is_frame(name):
+    return parse_frame(name) is not None
+
+def parse_range(text):
+    '''Parses a range of frames like START:STOP or START:STOP:STEP as slice, e.g. 10:50'''
+    parts = text.split(':')
+    if not 1 <= len(parts) <= 3:
+        raise ValueError('Invalid range of frames: ' + text)
+    if len(parts) == 1:
+        return slice(int(parts[0]), int(parts[0]) + 1)
+    return slice(*(int(part) if part else None for part in parts))
+
+class TiffStack:
+    '''Frames of a multi-frame TIFF, which are decoded with OpenCV when they are accessed'''
+    def __init__(self, path):
+        self.path = path
+        self.count = cv2.imcount(path)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        ok, frames = cv2.imreadmulti(self.path, index, 1, flags=cv2.IMREAD_GRAYSCALE)
+        if not ok:
+            raise IndexError('Frame %d of %s cannot be read' % (index, self.path))
+        return frames[0]
+
+@functools.lru_cache(maxsize=None)
+def open_stack(path, shape):
+    '''Returns the frames of the stack, indexed by the number of the frame, only opened once per process.
+       Raw stacks have no header, so the height and width of a frame are given by shape.'''
+    ending = os.path.splitext(path)[1].lower()
+    if ending == '.npy':
+        frames = np.load(path, mmap_mode='r')
+    elif ending == '.raw':
+        height, width = shape
+        frames = np.memmap(path, dtype=np.uint8, mode='r')
+        if len(frames) % (height * width):
+            raise ValueError('The size of %s is no multiple of frames of %dx%d pixels' % (path, width, height))
+        frames = frames.reshape(-1, height, width)
+    elif tifffile is not None:
+        try:
+            # Only uncompressed TIFFs can be memory-mapped
+            frames = tifffile.memmap(path, mode='r')
+        except ValueError:
+            frames = tifffile.imread(path)
+    else:
+        return TiffStack(path)
+
+    if frames.ndim == 2:
+        frames = frames[np.newaxis]
+    if frames.ndim != 3 or frames.dtype != np.uint8:
+        raise ValueError('%s is no stack of 8-bit grayscale frames, but %s of shape %s' % (path, frames.dtype, frames.shape))
+    return frames
+
+def read_frame(name, shape):
+    '''Returns the frame as read-only view into the stack'''
+    stack, index = parse_frame(name)
+    return open_stack(stack, shape)[index]
+
+def frame_names(stack, selection, shape):
+    '''Returns the names of the frames of the stack in the range selection, a slice'''
+    return [frame_name(stack, index) for index in range(len(open_stack(stack, shape)))[selection]]
+
+def hash_frame(name, shape):
+    '''Returns the SHA-1 of the pixels of the frame, like cache.hash_file for an image file'''
+    return hashlib.sha1(np.ascontiguousarray(read_frame(name, shape))).hexdigest()
+
+def frame_path(name, suffix):
+    '''Returns the path of an intermediate image of the frame, e.g. run_000042_align.jpg for run.npy:000042'''
+    stack, index = parse_frame(name)
+    return '%s_%06d%s.jpg' % (os.path.splitext(stack)[0], index, suffix)
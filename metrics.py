@@ -0,0 +1,188 @@
+'''Metrics of the stages: the time per image for decoding, computing and encoding, the number of lines and the memory.
+
+Every call of a function decorated with measure creates a record. Functions decorated with step, e.g. detect_line,
+add their time to the record of the running stage. The records of the worker processes are returned with the results
+of map_images, so that only the main process prints them and writes them to the sink.'''
+import os
+import sys
+import time
+import json
+import cProfile
+import functools
+import contextlib
+try:
+    import resource
+except ImportError:
+    resource = None  # Not available on Windows
+
+records = []    # Finished records of this process, which were not yet collected
+current = None  # Record of the running stage
+
+# Name of the stage or step which is profiled with cProfile
+profile_name = None
+profiler = None
+
+def configure(profile=None):
+    global profile_name
+    profile_name = profile
+
+def peak_rss():
+    '''Returns the peak of the resident memory of this process in bytes'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def call(func, *args):
+    '''Calls func, with cProfile if it is the profiled function. The statistics of all calls are saved per process.'''
+    global profiler
+    if func.__name__ != profile_name:
+        return func(*args)
+
+    profiler = profiler or cProfile.Profile()
+    profiler.enable()
+    try:
+        return func(*args)
+    finally:
+        profiler.disable()
+        profiler.dump_stats('profile_%s_%d.prof' % (profile_name, os.getpid()))
+
+def measure(func):
+    '''Decorator for the stages, every call creates a record for the image in the first argument'''
+    # functools.wraps keeps the name of the function, so that it can be pickled for the process pool
+    @functools.wraps(func)
+    def wrapper(*args):
+        global current
+        current = {'stage': func.__name__, 'image': args[0], 'decode': 0.0, 'encode': 0.0, 'steps': {}}
+        start = time.perf_counter()
+        try:
+            return call(func, *args)
+        finally:
+            record, current = current, None
+            record['seconds'] = time.perf_counter() - start
+            record['compute'] = record['seconds'] - record['decode'] - record['encode']
+            record['peak_rss'] = peak_rss()
+            records.append(record)
+
+    return wrapper
+
+def step(func):
+    '''Decorator for the steps of a stage, their time is added to the record of the running stage'''
+    @functools.wraps(func)
+    def wrapper(*args):
+        start = time.perf_counter()
+        result = call(func, *args)
+        if current is not None:
+            current['steps'][func.__name__] = current['steps'].get(func.__name__, 0) + time.perf_counter() - start
+        return result
+
+    return wrapper
+
+@contextlib.contextmanager
+def timer(phase):
+    '''Adds the time of the block to the phase decode or encode of the running stage'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if current is not None:
+            current[phase] += time.perf_counter() - start
+
+def annotate(**values):
+    '''Adds values to the record of the running stage, e.g. the number of lines'''
+    if current is not None:
+        current.update(values)
+
+def collect():
+    '''Returns the finished records of this process and forgets them'''
+    global records
+    collected, records = records, []
+    return collected
+
+class JsonLinesSink:
+    '''Appends every record as one line of JSON'''
+    def __init__(self, path):
+        self.file = open(path, 'a')
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class PrometheusSink:
+    '''Sums up the records and writes them in the textfile format of the node exporter of Prometheus'''
+    def __init__(self, path, interval=10):
+        self.path = path
+        self.interval = interval
+        self.written = 0
+        self.frames = {}    # Per stage
+        self.seconds = {}   # Per stage and phase
+        self.steps = {}     # Per step
+        self.lines = {}     # Per kind, unfiltered or filtered
+        self.peak = 0
+
+    def write(self, record):
+        stage = record['stage']
+        self.frames[stage] = self.frames.get(stage, 0) + 1
+        for phase in ['decode', 'compute', 'encode']:
+            self.seconds[stage, phase] = self.seconds.get((stage, phase), 0) + record[phase]
+        for name, seconds in record['steps'].items():
+            self.steps[name] = self.steps.get(name, 0) + seconds
+        for kind in ['unfiltered', 'filtered']:
+            if 'lines_' + kind in record:
+                self.lines[kind] = self.lines.get(kind, 0) + record['lines_' + kind]
+        self.peak = max(self.peak, record['peak_rss'] or 0)
+
+        # The file is rewritten at most every interval seconds, the collector reads it at any time
+        if time.time() - self.written > self.interval:
+            self.flush()
+
+    def flush(self):
+        metrics = [
+            ('cloudchamber_frames_total', 'counter', 'Number of processed images per stage',
+             [('stage="%s"' % stage, value) for stage, value in self.frames.items()]),
+            ('cloudchamber_stage_seconds_total', 'counter', 'Seconds spent per stage for decoding, computing and encoding',
+             [('stage="%s",phase="%s"' % key, value) for key, value in self.seconds.items()]),
+            ('cloudchamber_step_seconds_total', 'counter', 'Seconds spent per step of the stages',
+             [('step="%s"' % name, value) for name, value in self.steps.items()]),
+            ('cloudchamber_lines_total', 'counter', 'Number of detected lines before and after filtering',
+             [('kind="%s"' % kind, value) for kind, value in self.lines.items()]),
+            ('cloudchamber_peak_rss_bytes', 'gauge', 'Peak resident memory of the processes',
+             [('', self.peak)]),
+        ]
+        text = ''
+        for name, kind, description, samples in metrics:
+            text += '# HELP %s %s\n# TYPE %s %s\n' % (name, description, name, kind)
+            text += ''.join('%s%s %s\n' % (name, '{%s}' % labels if labels else '', value) for labels, value in samples)
+
+        # Replaced at once, so that the collector never reads a half written file
+        with open(self.path + '.tmp', 'w') as file:
+            file.write(text)
+        os.replace(self.path + '.tmp', self.path)
+        self.written = time.time()
+
+    def close(self):
+        self.flush()
+
+sink = None
+
+def open_sink(path):
+    '''Opens the sink for the records, a Prometheus textfile if path ends with .prom, else a JSON lines file'''
+    global sink
+    sink = PrometheusSink(path) if path.endswith('.prom') else JsonLinesSink(path)
+
+def close_sink():
+    global sink
+    if sink:
+        sink.close()
+        sink = None
+
+def emit(records):
+    '''Prints the records of a stage and writes them to the sink, only called in the main process'''
+    for record in records:
+        print('%s : %s -> %.1fs' % (record['stage'], record['image'], record['seconds']), flush=True)
+        if sink:
+            sink.write(record)
@@ -0,0 +1,67 @@
+'''Pipelined processing: reading, computing and writing of consecutive images overlap, so that the processors do not
+wait for the disk and the disk does not wait for the processors.
+
+Reader threads read the images ahead, the computation runs in a pool and a writer thread writes the results in the
+order of the images, several at once. Each part is at most depth images ahead of the next one, so the memory is
+bounded no matter how many images there are.'''
+import queue
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+def run(items, read, submit, write, readers=2, depth=4, batch=16):
+    '''Calls read(item) in reader threads, then submit(item), which starts the computation and returns a function
+       that waits for its result, and write([(item, result), ...]) in a writer thread, with up to batch items
+       whose results are ready. An exception of the computation or of write is raised again.'''
+    results = queue.Queue(maxsize=depth)
+    errors = []
+
+    def writer():
+        while True:
+            entry = results.get()
+            if entry is None:
+                return
+            entries = [entry]
+            # Further finished items are written together, the writer never waits for a batch to fill up
+            while len(entries) < batch:
+                try:
+                    entry = results.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is None:
+                    results.put(None)  # Seen again by the outer loop
+                    break
+                entries.append(entry)
+            if errors:
+                continue  # Only emptying the queue, so that the main thread is not blocked
+            try:
+                write([(item, wait()) for item, wait in entries])
+            except BaseException as error:
+                errors.append(error)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        with ThreadPoolExecutor(readers) as pool:
+            reads = collections.deque()
+            items = iter(items)
+            for item in items:
+                reads.append((item, pool.submit(read, item)))
+                # The readers are at most depth items ahead of the computation
+                while len(reads) >= depth:
+                    start(reads, submit, results, errors)
+            while reads:
+                start(reads, submit, results, errors)
+    finally:
+        results.put(None)
+        thread.join()
+    if errors:
+        raise errors[0]
+
+def start(reads, submit, results, errors):
+    '''Starts the computation of the oldest read item, blocks while depth computations wait for the writer'''
+    if errors:
+        raise errors[0]
+    item, read = reads.popleft()
+    read.result()
+    results.put((item, submit(item)))
@@ -1,8 +1,9 @@
-import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
+import numpy as np
 import os
-import csv
-import math
+from argparse import ArgumentParser
+
+import util  # Selfmade library
+from store import LineStore
 
 ## Constants
 Z = 2                           # Ordnungszahl des Teilchens
@@ -16,41 +17,41 @@ m_alpha = 6.644 * 10**(-27)     # Masse des stoßenden Teilchens (m_α = 6,644 
 m_e = 9.109 * 10**(-31)         # Elektronenmasse (m_e = 9,109 · 10^−31 kg)
 epsilon_0 = 8.854 * 10**(-12)   # Dielektrizitätskonstante (epsilon_0 = 8,854 · 10^−12)
 
-## Variables, EDIT HERE
+## Calibration, the defaults of the command line
 coinInMillimeter = 28.5
 coinInPixel = 292
 
+# Literature values of the alpha energies in MeV
+LITERATURE = [
+    (6.28808, r"Literaturwert $\alpha$ - Energie von $^{220}_{86}Rn$"),
+    (6.7783, r"Literaturwert $\alpha$ - Energie von $^{216}_{84}Po$"),
+]
+
 
 def loadCSV(file):
-    ''' Loads the CSV file and returns a list of lists depending on the number of images.
+    ''' Loads the CSV file or the folder of a LineStore.
+        Returns the lengths of the lines and per line the number of its image, both as arrays.
     '''
-    lengths = []
-    with open(file, 'r') as csvfile:
-        reader = csv.reader(csvfile, delimiter=',')
-        next(reader, None)  # skip the headers
-        id = -1
-        for row in reader:
-            newId = sum([int(s) for s in row[0].split('+') if s.isdigit()])
-            if newId != id:
-                lengths.append([])
-                id = newId
-            lengths[-1].append(float(row[1]))
-    return lengths
-
-def removePicturesWithTooManyLines(lengths, maxNumberOfLines):
-    ''' Removes all entries with too many lines.
+    if os.path.isdir(file):
+        lines = LineStore(file).read()
+        return lines.length, lines.frame
+
+    # The first column identifies the image, e.g. the filename
+    import pandas as pd
+    table = pd.read_csv(file)
+    imageIds, _ = pd.factorize(table.iloc[:, 0])
+    # The lengths are calculated from the points, older CSV files have the columns length and angle swapped
+    lengths = util.lengths(*(table[column].to_numpy() for column in ['p1_x', 'p1_y', 'p2_x', 'p2_y']))
+    return lengths, imageIds
+
+def removePicturesWithTooManyLines(lengths, imageIds, maxNumberOfLines):
+    ''' Removes the lines of all images with too many lines.
         The lines are probably wrong, because the program is not yet fully developed.
     '''
-    toRemove = []
-    for id, length in enumerate(lengths):
-        if len(length) > maxNumberOfLines:
-            toRemove.append(id)
+    numberOfLines = np.bincount(imageIds)
+    return lengths[numberOfLines[imageIds] <= maxNumberOfLines]
 
-    for i in reversed(toRemove):
-        del(lengths[i])
-    return lengths
-
-def pixelToMillimeter(length):
+def pixelToMillimeter(length, coinInMillimeter=coinInMillimeter, coinInPixel=coinInPixel):
     return coinInMillimeter * length / coinInPixel
 
 def geiger(length):
@@ -58,69 +59,69 @@ def geiger(length):
     '''
     return (length/3.1)**(2/3)
 
-def betheBloch(length):
+def betheBloch(length, Z=Z, n=n, Z_strich=Z_strich):
     ''' Returns the energy of the rays calculated according to Bethe-Bloch.
     '''
-    return math.sqrt(Z**2 * n * Z_strich * e**4 * m_alpha / 4 / math.pi / epsilon_0**2 / m_e * length * 10**(-3)) / e /10**6
-
+    return np.sqrt(Z**2 * n * Z_strich * e**4 * m_alpha / 4 / np.pi / epsilon_0**2 / m_e * length * 10**(-3)) / e /10**6
 
-if __name__ == '__main__':
-    ## Load the important line lengths from the CSV file
-    lengths = loadCSV('result.csv')
-    lengths = removePicturesWithTooManyLines(lengths, 10)
-    lengths = [item for sublist in lengths for item in sublist] # Flattens array
-
-    # Convert length in millimetres
-    for i in range(len(lengths)):
-        lengths[i] = pixelToMillimeter(lengths[i])
-
-
-    # Calculate the energy from the lengths
-    energy_geiger = []
-    energy_bethe = []
-    for length in lengths:
-        energy_geiger.append(geiger(length))
-        energy_bethe.append(betheBloch(length))
+def pyplot():
+    ''' Imports matplotlib only when plotting, with the backend Agg, which writes files without a display.
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
 
-    # ## Plot fogstrip length with histogram
+def plotHistogram(counts, edges, xlabel, path, literature=False):
+    ''' Plots the histogram from the counts per bin, e.g. from numpy.histogram.
+    '''
+    plt = pyplot()
     fig = plt.figure(figsize=(15, 10))
     plt.rc('xtick', labelsize=25)
     plt.rc('ytick', labelsize=25)
 
-    plt.hist(lengths, bins=100)
-    plt.xlabel(r"Länge [mm]", fontsize=35)
+    plt.stairs(counts, edges, fill=True)
+    if literature:
+        for i, (energy, label) in enumerate(LITERATURE):
+            plt.axvline(energy, color='C%d' % (i + 1), label=label)
+        plt.legend(fontsize=25)
+    plt.xlabel(xlabel, fontsize=35)
     plt.ylabel(r"Häufigkeit", fontsize=35)
-    plt.legend(fontsize=25)
 
-    fig.savefig('../bilder/histogram_laenge_automatic.png', dpi=200)
-    #plt.show()
+    fig.savefig(path, dpi=200)
+    plt.close(fig)
+
+def main():
+    parser = ArgumentParser(description="Histograms of the lengths and energies of the detected lines")
+    parser.add_argument('input', nargs='?', default='lines_filtered', help='folder of the store with the lines or CSV file')
+    parser.add_argument('-o', '--output', default='../bilder', help='folder of the histograms')
+    parser.add_argument('--max_lines', type=int, default=10, help='images with more lines are ignored')
+    parser.add_argument('--bins', type=int, default=100, help='number of bins of the histograms')
+    parser.add_argument('--coin_mm', type=float, default=coinInMillimeter, help='diameter of the coin in millimetres')
+    parser.add_argument('--coin_px', type=float, default=coinInPixel, help='diameter of the coin in pixels')
+    parser.add_argument('--Z', type=float, default=Z, help='atomic number of the particle')
+    parser.add_argument('--n', type=float, default=n, help='particle density of the stopping material')
+    parser.add_argument('--Z_strich', type=float, default=Z_strich, help='atomic number of the stopping material')
+    args = parser.parse_args()
+
+    ## Load the important line lengths
+    lengths, imageIds = loadCSV(args.input)
+    lengths = removePicturesWithTooManyLines(lengths, imageIds, args.max_lines)
 
-    ## Plot energy calculated according to Bethe-Bloch in a histogram
-    fig = plt.figure(figsize=(15, 10))
-    plt.rc('xtick', labelsize=25)
-    plt.rc('ytick', labelsize=25)
-
-    plt.hist(energy_bethe, bins=100)
-    line1, = plt.plot((6.28808, 6.288081), (0, 12), '-', label=r"Literaturwert $\alpha$ - Energie von $^{220}_{86}Rn$")
-    line2, = plt.plot((6.7783, 6.7783), (0, 12), '-', label=r"Literaturwert $\alpha$ - Energie von $^{216}_{84}Po$")
-    plt.xlabel(r"Energie [MeV]", fontsize=35)
-    plt.ylabel(r"Häufigkeit", fontsize=35)
-    plt.legend(fontsize=25)
-
-    fig.savefig('../bilder/histogram_bethebloch_automatic.png', dpi=200)
-    #plt.show()
+    # Convert length in millimetres
+    lengths = pixelToMillimeter(lengths, args.coin_mm, args.coin_px)
 
-    ## Plot energy calculated according to Geiger in a histogram
-    fig = plt.figure(figsize=(15, 10))
-    plt.rc('xtick', labelsize=25)
-    plt.rc('ytick', labelsize=25)
+    # Calculate the energy from the lengths
+    energy_geiger = geiger(lengths)
+    energy_bethe = betheBloch(lengths, args.Z, args.n, args.Z_strich)
 
-    plt.hist(energy_geiger, bins=100)
-    line1, = plt.plot((6.28808, 6.288081), (0, 12), '-', label=r"Literaturwert $\alpha$ - Energie von $^{220}_{86}Rn$")
-    line2, = plt.plot((6.7783, 6.7783), (0, 12), '-', label=r"Literaturwert $\alpha$ - Energie von $^{216}_{84}Po$")
-    plt.xlabel(r"Energie [MeV]", fontsize=35)
-    plt.ylabel(r"Häufigkeit", fontsize=35)
-    plt.legend(fontsize=25)
+    os.makedirs(args.output, exist_ok=True)
+    plotHistogram(*np.histogram(lengths, bins=args.bins), r"Länge [mm]",
+                  os.path.join(args.output, 'histogram_laenge_automatic.png'))
+    plotHistogram(*np.histogram(energy_bethe, bins=args.bins), r"Energie [MeV]",
+                  os.path.join(args.output, 'histogram_bethebloch_automatic.png'), literature=True)
+    plotHistogram(*np.histogram(energy_geiger, bins=args.bins), r"Energie [MeV]",
+                  os.path.join(args.output, 'histogram_geiger_automatic.png'), literature=True)
 
-    fig.savefig('../bilder/histogram_geiger_automatic.png', dpi=200)
-    #plt.show()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+'''Local service: cloudchamber --serve keeps its processes with the loaded backgrounds and aligners running and
+analyses the images sent to a Unix socket. Every request and every answer is one line of JSON:
+
+{"images": ["/data/a.jpg", "/data/b.jpg"]} answers {"results": [{"image": "/data/a.jpg", "lines": [[x1, y1, x2, y2], ...]}, ...]}
+{"status": true} answers the number of images in progress and the throughput
+
+This module has the server and the client, e.g. python service.py cloudchamber.sock images...'''
+import os
+import sys
+import stat
+import json
+import socket
+import socketserver
+from argparse import ArgumentParser
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # A connection can send several requests, each is answered before the next is read
+        for line in self.rfile:
+            try:
+                answer = self.server.respond(json.loads(line))
+            except Exception as error:
+                answer = {'error': str(error)}
+            self.wfile.write((json.dumps(answer) + '\n').encode())
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''Answers the requests on the socket path with respond(request), every connection in its own thread'''
+    daemon_threads = True
+
+    def __init__(self, path, respond):
+        # The socket of a server that was killed is still there
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+        self.respond = respond
+        super().__init__(path, Handler)
+
+    def server_close(self):
+        super().server_close()
+        os.remove(self.server_address)
+
+def request(path, message):
+    '''Sends the request to the server and returns its answer'''
+    with socket.socket(socket.AF_UNIX) as connection:
+        connection.connect(path)
+        connection.sendall((json.dumps(message) + '\n').encode())
+        with connection.makefile('r') as file:
+            answer = json.loads(file.readline())
+    if 'error' in answer:
+        raise RuntimeError(answer['error'])
+    return answer
+
+def submit(path, images):
+    '''Returns the filtered lines of the images, the paths are made absolute for the server'''
+    return request(path, {'images': [os.path.abspath(image) for image in images]})['results']
+
+def status(path):
+    return request(path, {'status': True})
+
+def main():
+    parser = ArgumentParser(description="Sends images to a running cloudchamber --serve, without images its status is shown")
+    parser.add_argument('socket', help='socket of the server, as given to --serve')
+    parser.add_argument('images', nargs='*', help='images to be analysed')
+    args = parser.parse_args()
+
+    if not args.images:
+        print(json.dumps(status(args.socket), indent=2))
+        return
+
+    failed = False
+    for result in submit(args.socket, args.images):
+        if 'error' in result:
+            print('%s : %s' % (result['image'], result['error']))
+            failed = True
+        else:
+            print('%s : %d lines' % (result['image'], len(result['lines'])))
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
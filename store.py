@@ -0,0 +1,164 @@
+'''Append-only store for the lines of many images.
+
+A store is a folder with one NPZ file per appended chunk of lines and the file index.jsonl,
+which has one line per chunk with the number of lines of every image in the chunk.
+The index is enough to check whether an image is already analysed and to find the chunks of an image.'''
+import numpy as np
+import os
+import json
+from argparse import ArgumentParser
+
+import util  # Selfmade library
+
+def writeLines(file, lines):
+    '''Writes the columns of a LineSet into an NPZ file'''
+    np.savez(file, filenames=np.array(lines.filenames, dtype=str),
+             **{column: getattr(lines, column) for column in util.LineSet.columns})
+
+def readLines(path):
+    '''Reads a LineSet written by writeLines'''
+    with np.load(path) as file:
+        columns = {column: file[column] for column in util.LineSet.columns}
+        filenames = file['filenames'].tolist()
+    return util.LineSet(columns['x1'], columns['y1'], columns['x2'], columns['y2'], columns['frame'], filenames,
+                        length=columns['length'], angle=columns['angle'])
+
+class LineStore:
+    def __init__(self, path):
+        self.path = path
+        self.chunks = []    # Per chunk the file and the number of lines per filename
+        self.chunkOf = {}   # Per filename the number of the chunk with its lines
+
+        index = os.path.join(path, 'index.jsonl')
+        if os.path.isfile(index):
+            with open(index, 'r') as file_index:
+                for line in file_index:
+                    try:
+                        chunk = json.loads(line)
+                    except ValueError:
+                        break  # Last line of an interrupted append
+                    self._addToIndex(chunk)
+
+    def _addToIndex(self, chunk):
+        for filename in chunk['counts']:
+            self.chunkOf[filename] = len(self.chunks)
+        self.chunks.append(chunk)
+
+    def __contains__(self, filename):
+        return filename in self.chunkOf
+
+    def __len__(self):
+        '''Returns the number of lines in the store'''
+        return sum(self.counts().values())
+
+    def filenames(self):
+        '''Returns the filenames in the order they were appended'''
+        return list(self.chunkOf)
+
+    def counts(self):
+        '''Returns the number of lines per filename, without reading the lines'''
+        return {filename: count for chunk in self.chunks for filename, count in chunk['counts'].items()}
+
+    def keys(self):
+        '''Returns the cache key of the lines per filename, for the filenames that were appended with a key'''
+        return {filename: key for number, chunk in enumerate(self.chunks) for filename, key in chunk.get('keys', {}).items()
+                if self.chunkOf[filename] == number}
+
+    def key(self, filename):
+        '''Returns the cache key of the lines of the image or None'''
+        if filename not in self.chunkOf:
+            return None
+        return self.chunks[self.chunkOf[filename]].get('keys', {}).get(filename)
+
+    def append(self, lines, keys=None):
+        '''Appends the lines of one or more images as new chunk, images without lines are registered too.
+           keys maps the filenames to the cache keys of the stage that produced the lines.'''
+        os.makedirs(self.path, exist_ok=True)
+        file = 'chunk_%06d.npz' % len(self.chunks)
+
+        # Written under a temporary name first, so that the index never points to an incomplete chunk
+        path_tmp = os.path.join(self.path, file + '.tmp')
+        with open(path_tmp, 'wb') as file_chunk:
+            writeLines(file_chunk, lines)
+        os.replace(path_tmp, os.path.join(self.path, file))
+
+        counts = np.bincount(lines.frame, minlength=len(lines.filenames)).tolist()
+        chunk = {'file': file, 'counts': dict(zip(lines.filenames, counts))}
+        if keys:
+            chunk['keys'] = keys
+        with open(os.path.join(self.path, 'index.jsonl'), 'a') as file_index:
+            file_index.write(json.dumps(chunk) + '\n')
+        self._addToIndex(chunk)
+
+    def readChunk(self, number):
+        return readLines(os.path.join(self.path, self.chunks[number]['file']))
+
+    def read(self, filenames=None):
+        '''Returns the lines of the given images or of all images, only the chunks with these images are read'''
+        if filenames is None:
+            filenames = self.filenames()
+        filenames = [filename for filename in filenames if filename in self.chunkOf]
+        wanted = set(filenames)
+
+        lineSets = []
+        for number in sorted({self.chunkOf[filename] for filename in filenames}):
+            lines = self.readChunk(number)
+            # A filename which was appended again is only read from its last chunk
+            latest = [i for i, filename in enumerate(lines.filenames) if filename in wanted and self.chunkOf[filename] == number]
+            selected = lines[np.isin(lines.frame, latest)]
+            # The other images of the chunk are not part of the result, so the frames are numbered again
+            frame = np.zeros(len(lines.filenames), dtype=np.int32)
+            frame[latest] = np.arange(len(latest))
+            lineSets.append(util.LineSet(selected.x1, selected.y1, selected.x2, selected.y2, frame[selected.frame],
+                                         [lines.filenames[i] for i in latest], length=selected.length, angle=selected.angle))
+        return util.LineSet.concatenate(lineSets, filenames)
+
+    def query(self, filenames=None, min_length=None, max_length=None, min_angle=None, max_angle=None):
+        '''Returns the lines of the given images, whose length and angle are within the given limits'''
+        lines = self.read(filenames)
+        mask = np.ones(len(lines), dtype=bool)
+        if min_length is not None:
+            mask &= lines.length >= min_length
+        if max_length is not None:
+            mask &= lines.length <= max_length
+        if min_angle is not None:
+            mask &= lines.angle >= min_angle
+        if max_angle is not None:
+            mask &= lines.angle <= max_angle
+        return lines[mask]
+
+    def clear(self):
+        '''Removes all lines from the store'''
+        for chunk in self.chunks:
+            os.remove(os.path.join(self.path, chunk['file']))
+        if os.path.isfile(os.path.join(self.path, 'index.jsonl')):
+            os.remove(os.path.join(self.path, 'index.jsonl'))
+        self.chunks = []
+        self.chunkOf = {}
+
+    def compact(self):
+        '''Rewrites the store as a single chunk, e.g. after many appends of single images'''
+        lines = self.read(self.filenames())
+        keys = self.keys()
+        self.clear()
+        self.append(lines, keys)
+
+def main():
+    parser = ArgumentParser(description="Shows and exports the lines in a store")
+    parser.add_argument('store', help='folder of the store, e.g. lines_filtered')
+    parser.add_argument('--csv', metavar='FILE', help='export the lines as CSV file')
+    parser.add_argument('--compact', action='store_true', help='rewrite the store as a single chunk')
+    parser.add_argument('filenames', nargs='*', help='only these images')
+    args = parser.parse_args()
+
+    store = LineStore(args.store)
+    if args.compact:
+        store.compact()
+
+    lines = store.read(args.filenames or None)
+    if args.csv:
+        lines.toDataFrame().to_csv(args.csv, index=False)
+    print('%d lines of %d images' % (len(lines), len(lines.filenames)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+'''Parameter sweep: analyses the images with every combination of a grid of options and writes a table with the
+number of lines and the time of each combination.
+
+A step is only repeated when one of its options changes: every image is decoded and aligned once, the background is
+removed once per --threshold and the Canny edges of hough are calculated once per threshold and --canny. Only the
+Hough transform and the filtering run for every combination. The images are spread over args.jobs processes.'''
+import numpy as np
+import time
+import itertools
+import functools
+import contextlib
+from multiprocessing import Pool
+from argparse import ArgumentParser
+
+import util  # Selfmade library
+import cloudchamber
+import detectors
+import frames
+
+# Options which can be swept, in the order of the steps which use them
+PARAMETERS = ['threshold', 'canny', 'detector', 'detector_downscale', 'tile', 'tile_overlap',
+              'hough_threshold', 'min_line_length', 'max_line_gap', 'angle_tolerance']
+
+def parse_grid(texts):
+    '''Parses the grid like ['threshold=3,5', 'canny=20:40,30:60'] into a dictionary of the values per option.
+       The values are kept as text, they are converted by the parser of cloudchamber.'''
+    grid = {}
+    for text in texts:
+        name, separator, values = text.partition('=')
+        if not separator or name not in PARAMETERS:
+            raise ValueError('Invalid grid %s, expected NAME=VALUE,VALUE with NAME one of %s' % (text, ', '.join(PARAMETERS)))
+        grid[name] = values.split(',')
+    return grid
+
+def configurations(grid, base):
+    '''Returns the options of every combination of the grid, the other options are given by the arguments base.
+       They are sorted by threshold and canny, so that the combinations with the same edges follow each other.'''
+    names = sorted(grid, key=PARAMETERS.index)
+    result = []
+    for values in itertools.product(*(grid[name] for name in names)):
+        argv = list(base)
+        for name, value in zip(names, values):
+            argv += ['--' + name] + value.split(':')
+        options = cloudchamber.parse_args(argv + ['--no_cache', 'sweep.jpg'])
+        options.grid = dict(zip(names, values))
+        result.append(options)
+    return sorted(result, key=lambda options: (options.threshold, options.canny))
+
+def timed(func, *args):
+    start = time.perf_counter()
+    return func(*args), time.perf_counter() - start
+
+def detect(img_wo_bkgnd, edges, options):
+    '''Detects the lines like cloudchamber.detect_line, for hough on the given edges of the region of interest'''
+    if edges is None:
+        return cloudchamber.detect_line(img_wo_bkgnd, '')
+    box = roi_box(options)
+    points = detectors.hough_lines(edges, options)
+    if box is not None:
+        points = points + np.array([box[1].start, box[0].start] * 2, dtype=np.int32)
+    return util.LineSet.fromPoints(points, '')
+
+def roi_box(options):
+    roi = cloudchamber.load_roi(options.roi, options.threshold, options.background)
+    return roi and roi[1]
+
+def uses_edges(options):
+    return options.detector == 'hough' and not options.tile
+
+def sweep_image(image, configurations):
+    '''Analyses the image with every configuration, returns per configuration the numbers of lines and the times.
+       The times of the shared steps are added to every configuration, as if it had been run alone.'''
+    cloudchamber.configure(configurations[0])
+    img_aligned, seconds_align = timed(lambda: cloudchamber.align(cloudchamber.read_image(image)))
+
+    rows = []
+    for _, by_threshold in itertools.groupby(configurations, lambda options: options.threshold):
+        by_threshold = list(by_threshold)
+        cloudchamber.configure(by_threshold[0])
+        img_wo_bkgnd, seconds_background = timed(cloudchamber.remove_background, img_aligned)
+
+        for _, by_canny in itertools.groupby(by_threshold, lambda options: options.canny):
+            by_canny = list(by_canny)
+            edges, seconds_canny = None, 0.0
+            if any(uses_edges(options) for options in by_canny):
+                box = roi_box(by_canny[0])
+                region = img_wo_bkgnd if box is None else np.ascontiguousarray(img_wo_bkgnd[box])
+                edges, seconds_canny = timed(detectors.canny, region, by_canny[0])
+
+            for options in by_canny:
+                cloudchamber.configure(options)
+                lines, seconds_detect = timed(detect, img_wo_bkgnd, edges if uses_edges(options) else None, options)
+                lines_filtered, seconds_filter = timed(cloudchamber.filter_line, lines)
+                rows.append({
+                    'lines_unfiltered': len(lines),
+                    'lines_filtered': len(lines_filtered),
+                    'detect_seconds': seconds_detect + (seconds_canny if uses_edges(options) else 0),
+                    'filter_seconds': seconds_filter,
+                    'seconds': seconds_align + seconds_background + seconds_detect + seconds_filter
+                               + (seconds_canny if uses_edges(options) else 0),
+                })
+    return rows
+
+def sweep(images, configurations, jobs):
+    '''Returns the table with one row per configuration, summed over the images'''
+    import pandas  # Imported only here, it slows down the start of the program
+
+    totals = [dict.fromkeys(['lines_unfiltered', 'lines_filtered', 'detect_seconds', 'filter_seconds', 'seconds'], 0)
+              for _ in configurations]
+    func = functools.partial(sweep_image, configurations=configurations)
+    with Pool(jobs) if jobs > 1 else contextlib.nullcontext() as p:
+        for rows in (p.imap(func, images) if p else map(func, images)):
+            for total, row in zip(totals, rows):
+                for column, value in row.items():
+                    total[column] += value
+
+    return pandas.DataFrame([dict(options.grid, images=len(images), **total)
+                             for options, total in zip(configurations, totals)])
+
+def main():
+    parser = ArgumentParser(description="Analyses the images with every combination of a grid of options")
+    parser.add_argument('images', nargs='+', help='images or stacks of frames to be analysed')
+    parser.add_argument('-g', '--grid', nargs='+', required=True, metavar='NAME=VALUES',
+                        help='values of the options, e.g. threshold=3,5,8 canny=20:40,30:60 hough_threshold=10,20, '
+                        'NAME is one of ' + ', '.join(PARAMETERS))
+    parser.add_argument('-o', '--options', default='', metavar='OPTIONS',
+                        help='further options of cloudchamber for all combinations, e.g. "--roi auto --align none"')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N', help='number of processes that analyse the images in parallel')
+    parser.add_argument('--csv', metavar='FILE', help='also write the table as CSV file')
+    args = parser.parse_args()
+
+    try:
+        grid = parse_grid(args.grid)
+    except ValueError as error:
+        parser.error(str(error))
+    configs = configurations(grid, args.options.split())
+    base = configs[0]
+
+    images = [x for x in args.images if not frames.is_stack(x)]
+    for stack in (x for x in args.images if frames.is_stack(x)):
+        images += frames.frame_names(stack, base.frames, tuple(base.frame_shape))
+
+    start = time.perf_counter()
+    table = sweep(images, configs, args.jobs)
+    seconds = time.perf_counter() - start
+
+    print(table.to_string(index=False))
+    print('%d combinations of %d images in %.1fs, %.1fs if run one after the other'
+          % (len(configs), len(images), seconds, table['seconds'].sum()))
+    if args.csv:
+        table.to_csv(args.csv, index=False)
+
+if __name__ == "__main__":
+    main()
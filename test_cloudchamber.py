@@ -1,6 +1,32 @@
 import unittest
 import util
+import cloudchamber
+import metrics
+import plot
+import math
 import numpy as np
+import imageio
+import os
+import tempfile
+import cv2
+import imreg_dft as ird
+
+from store import LineStore
+from align import Aligner
+from cache import StageCache, hash_file, stage_key
+import detectors
+import frames
+import codec
+import background
+import tracks
+import sweep
+import service
+import pipeline
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from detectors import DETECTORS
+
+directory = os.path.dirname(os.path.abspath(__file__))
 
 class Test_angleBetween(unittest.TestCase):
     def test_degree0(self):
@@ -103,6 +129,863 @@ class Test_sortForAngle(unittest.TestCase):
         lines = [line1, line2, line3]
         self.assertEqual(util.sortByAngle(lines, 5), [[line1, line3], [line2]])
 
+    def test_wraparound(self):
+        # 179 and -178 degree are almost the same direction as 1 degree
+        angles = [179, 90, 1, -178, 95]
+        self.assertEqual([x.tolist() for x in util.groupByAngle(angles, 5)], [[0, 2, 3], [1, 4]])
+
+    def test_order_independent(self):
+        rng = np.random.default_rng(0)
+        angles = rng.uniform(-180, 180, 200)
+        groups = {frozenset(x.tolist()) for x in util.groupByAngle(angles, 3)}
+        permutation = rng.permutation(200)
+        groupsPermuted = {frozenset(permutation[x].tolist()) for x in util.groupByAngle(angles[permutation], 3)}
+        self.assertEqual(groups, groupsPermuted)
+
+    def test_lineset(self):
+        lines = util.LineSet.fromPoints(np.array([[0, 0, 10, 0], [0, 0, 0, 10], [10, 1, 0, 0]]), 'a.jpg')
+        self.assertEqual([len(x) for x in util.sortByAngle(lines, 10)], [2, 1])
+
+class Test_LineSet(unittest.TestCase):
+    def setUp(self):
+        self.lines = [util.Line(0,0,1,1,'a.jpg'), util.Line(5,5,0,9,'b.jpg'), util.Line(3,0,0,0,'a.jpg')]
+        self.lineSet = util.LineSet.fromLines(self.lines)
+
+    def test_length_and_angle(self):
+        np.testing.assert_array_equal(self.lineSet.length, [line.length for line in self.lines])
+        np.testing.assert_array_equal(self.lineSet.angle, [line.angle for line in self.lines])
+
+    def test_fromPoints(self):
+        lineSet = util.LineSet.fromPoints(np.array([[[0, 0, 1, 1]], [[5, 5, 0, 9]]], dtype=np.int32), 'a.jpg')
+        self.assertEqual(lineSet.points.tolist(), [[0, 0, 1, 1], [5, 5, 0, 9]])
+        self.assertEqual(len(util.LineSet.fromPoints(None, 'a.jpg')), 0)
+
+    def test_dataFrame_without_copy(self):
+        df = self.lineSet.toDataFrame()
+        self.assertEqual(list(df.columns), ['filename', 'angle', 'length', 'p1_x', 'p1_y', 'p2_x', 'p2_y'])
+        self.assertEqual(list(df.filename), ['a.jpg', 'b.jpg', 'a.jpg'])
+        self.assertTrue(np.shares_memory(df.p1_x.to_numpy(), self.lineSet.x1))
+
+        lineSet = util.LineSet.fromDataFrame(df)
+        self.assertTrue(np.shares_memory(lineSet.x1, self.lineSet.x1))
+        self.assertEqual(lineSet.points.tolist(), self.lineSet.points.tolist())
+        self.assertEqual(lineSet.filenames, ['a.jpg', 'b.jpg'])
+
+    def test_split_and_concatenate(self):
+        lineSets = self.lineSet.splitByFilename()
+        self.assertEqual([lines.filenames for lines in lineSets], [['a.jpg'], ['b.jpg']])
+        self.assertEqual(lineSets[0].points.tolist(), [[0, 0, 1, 1], [3, 0, 0, 0]])
+
+        lineSet = util.LineSet.concatenate(lineSets[::-1], self.lineSet.filenames)
+        self.assertEqual(list(lineSet.toDataFrame().filename), ['b.jpg', 'a.jpg', 'a.jpg'])
+
+    def test_sortByAngle(self):
+        self.assertEqual([lines.points.tolist() for lines in util.sortByAngle(self.lineSet, 5)],
+                         [[[0, 0, 1, 1]], [[5, 5, 0, 9]], [[3, 0, 0, 0]]])
+
+class Test_LineStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'lines')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_append_and_read(self):
+        store = LineStore(self.path)
+        store.append(util.LineSet.fromPoints([[0, 0, 1, 1], [0, 0, 5, 0]], 'a.jpg'))
+        store.append(util.LineSet.fromPoints(None, 'b.jpg'))
+        store.append(util.LineSet.fromPoints([[2, 2, 2, 9]], 'c.jpg'))
+
+        store = LineStore(self.path)
+        self.assertIn('b.jpg', store)
+        self.assertNotIn('d.jpg', store)
+        self.assertEqual(store.counts(), {'a.jpg': 2, 'b.jpg': 0, 'c.jpg': 1})
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store.read().points.tolist(), [[0, 0, 1, 1], [0, 0, 5, 0], [2, 2, 2, 9]])
+        self.assertEqual(store.read(['c.jpg']).points.tolist(), [[2, 2, 2, 9]])
+        self.assertEqual(store.query(min_length=3).points.tolist(), [[0, 0, 5, 0], [2, 2, 2, 9]])
+
+    def test_append_again_replaces(self):
+        store = LineStore(self.path)
+        store.append(util.LineSet.fromPoints([[0, 0, 1, 1]], 'a.jpg'))
+        store.append(util.LineSet.fromPoints([[3, 3, 4, 4]], 'a.jpg'))
+        self.assertEqual(store.read().points.tolist(), [[3, 3, 4, 4]])
+        self.assertEqual(len(store), 1)
+
+        store.compact()
+        self.assertEqual(len(LineStore(self.path).chunks), 1)
+        self.assertEqual(LineStore(self.path).read().points.tolist(), [[3, 3, 4, 4]])
+
+    def test_read_part_of_chunk(self):
+        store = LineStore(self.path)
+        store.append(util.LineSet.concatenate([util.LineSet.fromPoints([[0, 0, 1, 1]], 'a.jpg'),
+                                               util.LineSet.fromPoints(None, 'b.jpg'),
+                                               util.LineSet.fromPoints([[2, 2, 2, 9]], 'c.jpg')]))
+        lines = store.read(['c.jpg', 'b.jpg'])
+        self.assertEqual(lines.filenames, ['c.jpg', 'b.jpg'])
+        self.assertEqual(lines.points.tolist(), [[2, 2, 2, 9]])
+        self.assertEqual([len(x) for x in lines.splitByFilename()], [1, 0])
+
+    def test_interrupted_append(self):
+        store = LineStore(self.path)
+        store.append(util.LineSet.fromPoints([[0, 0, 1, 1]], 'a.jpg'))
+        with open(os.path.join(self.path, 'index.jsonl'), 'a') as file_index:
+            file_index.write('{"file": "chunk_0000')
+        self.assertEqual(LineStore(self.path).filenames(), ['a.jpg'])
+
+    def test_clear(self):
+        store = LineStore(self.path)
+        store.append(util.LineSet.fromPoints([[0, 0, 1, 1]], 'a.jpg'))
+        store.clear()
+        self.assertEqual(len(LineStore(self.path)), 0)
+
+    def test_keys(self):
+        store = LineStore(self.path)
+        store.append(util.LineSet.fromPoints([[0, 0, 1, 1]], 'a.jpg'), {'a.jpg': 'key1'})
+        store.append(util.LineSet.fromPoints(None, 'b.jpg'))
+        store.append(util.LineSet.fromPoints([[3, 3, 4, 4]], 'a.jpg'), {'a.jpg': 'key2'})
+        store.compact()
+
+        store = LineStore(self.path)
+        self.assertEqual(store.key('a.jpg'), 'key2')
+        self.assertIsNone(store.key('b.jpg'))
+        self.assertIsNone(store.key('c.jpg'))
+
+class Test_StageCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'cache')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'wb') as file:
+            file.write(content)
+        return path
+
+    def test_stage_key(self):
+        key = stage_key('detect_line', ['abc'], canny=[20, 40])
+        self.assertEqual(key, stage_key('detect_line', ['abc'], canny=[20, 40]))
+        self.assertNotEqual(key, stage_key('detect_line', ['abd'], canny=[20, 40]))
+        self.assertNotEqual(key, stage_key('detect_line', ['abc'], canny=[20, 41]))
+
+    def test_hash_file(self):
+        path = self.write('a.jpg', b'a')
+        hash_a = hash_file(path)
+        os.utime(path, ns=(0, 0))
+        self.write('a.jpg', b'b')
+        self.assertNotEqual(hash_file(path), hash_a)
+
+    def test_put_and_get(self):
+        cache = StageCache(self.path, 2**20)
+        destination = os.path.join(self.directory.name, 'b.jpg')
+        self.assertFalse(cache.get_file('key', '.jpg', destination))
+        self.assertIsNone(cache.get_lines('key'))
+
+        cache.put_file('key', '.jpg', self.write('a.jpg', b'image'))
+        cache.put_lines('key', util.LineSet.fromPoints([[0, 0, 1, 1]], 'a.jpg'))
+        self.assertTrue(cache.get_file('key', '.jpg', destination))
+        with open(destination, 'rb') as file:
+            self.assertEqual(file.read(), b'image')
+        self.assertEqual(cache.get_lines('key').points.tolist(), [[0, 0, 1, 1]])
+
+    def test_evict_least_recently_used(self):
+        cache = StageCache(self.path, 2**20)
+        for i, key in enumerate(['a', 'b', 'c']):
+            cache.put_file(key, '.jpg', self.write(key, bytes(100)))
+            os.utime(cache.entry(key, '.jpg'), ns=(i, i))
+
+        cache = StageCache(self.path, 250)
+        # a is used again, so b is the least recently used entry
+        cache.get_file('a', '.jpg', os.path.join(self.directory.name, 'copy'))
+        cache.evict()
+
+        self.assertEqual(sorted(os.listdir(self.path)), ['a.jpg', 'c.jpg'])
+        self.assertEqual(cache.size(), 200)
+
+class ExampleRun(unittest.TestCase):
+    '''Runs the program in a temporary folder on two images made from the example image'''
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+        # The backgrounds are looked for in the folder background of the working directory, at half the size the run is faster
+        os.mkdir('background')
+        for name in ['background.jpg', 'background_with_stripes.jpg']:
+            cv2.imwrite(os.path.join('background', name), self.read_half(os.path.join(directory, 'background', name)))
+        image = self.read_half(os.path.join(directory, 'example_data', 'Nebelkammer_000.jpg'))
+        cv2.imwrite('a.jpg', image)
+        cv2.imwrite('b.jpg', cv2.flip(image, 1))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def read_half(self, path):
+        return cv2.resize(cv2.imread(path, cv2.IMREAD_GRAYSCALE), None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
+
+    def run_program(self, *argv):
+        args = cloudchamber.parse_args(['--align', 'none', '--no_cache'] + list(argv) + ['a.jpg', 'b.jpg'])
+        cloudchamber.configure(args)
+        args.type(sorted(args.images), args)
+
+    def read_store(self, path):
+        store = LineStore(path)
+        return [(filename, store.read([filename]).points.tolist()) for filename in sorted(store.filenames())], store.counts()
+
+class Test_map_images(ExampleRun):
+    def test_jobs(self):
+        # The lines are appended in the order of the images, no matter which process finishes first
+        os.mkdir('one')
+        os.mkdir('two')
+        for folder, jobs in [('one', '1'), ('two', '2')]:
+            self.run_program('-c', '-j', jobs)
+            os.rename(cloudchamber.LINES_UNFILTERED, os.path.join(folder, 'unfiltered'))
+            os.rename(cloudchamber.LINES_FILTERED, os.path.join(folder, 'filtered'))
+
+        for store in ['unfiltered', 'filtered']:
+            self.assertEqual(LineStore(os.path.join('one', store)).chunks, LineStore(os.path.join('two', store)).chunks)
+            self.assertEqual(self.read_store(os.path.join('one', store)), self.read_store(os.path.join('two', store)))
+        lines, counts = self.read_store(os.path.join('two', 'filtered'))
+        self.assertEqual([filename for filename, _ in lines], ['a.jpg', 'b.jpg'])
+        self.assertTrue(all(counts.values()))
+        self.assertTrue(os.path.isfile('b_result.jpg'))
+
+class Test_stream(ExampleRun):
+    def test_stores(self):
+        self.run_program('-s')
+        lines, counts = self.read_store(cloudchamber.LINES_FILTERED)
+        self.assertEqual([filename for filename, _ in lines], ['a.jpg', 'b.jpg'])
+        self.assertTrue(all(counts.values()))
+        self.assertEqual(LineStore(cloudchamber.LINES_UNFILTERED).counts().keys(), counts.keys())
+        # Only the lines are written
+        self.assertEqual(sorted(x for x in os.listdir('.') if x.endswith('.jpg')), ['a.jpg', 'b.jpg'])
+
+        # A second run finds the lines in the stores and appends nothing
+        chunks = LineStore(cloudchamber.LINES_FILTERED).chunks
+        self.run_program('-s')
+        self.assertEqual(LineStore(cloudchamber.LINES_FILTERED).chunks, chunks)
+        self.assertEqual(self.read_store(cloudchamber.LINES_FILTERED), (lines, counts))
+
+    def test_debug_images(self):
+        self.run_program('-s', '--debug_images')
+        for suffix in cloudchamber.INTERMEDIATE_SUFFIXES:
+            self.assertTrue(os.path.isfile('a%s.jpg' % suffix))
+            self.assertTrue(os.path.isfile('b%s.jpg' % suffix))
+        self.assertEqual(len(LineStore(cloudchamber.LINES_FILTERED).filenames()), 2)
+
+    def test_debug_images_after_run(self):
+        # The lines are in the stores already, the images are written anyway
+        self.run_program('-s')
+        self.run_program('-s', '--debug_images')
+        for suffix in cloudchamber.INTERMEDIATE_SUFFIXES:
+            self.assertTrue(os.path.isfile('a%s.jpg' % suffix))
+            self.assertTrue(os.path.isfile('b%s.jpg' % suffix))
+
+class Test_stage_keys(ExampleRun):
+    def detect_key(self, *argv):
+        cloudchamber.configure(cloudchamber.parse_args(list(argv) + ['a.jpg']))
+        return cloudchamber.stage_keys('a.jpg')[2]
+
+    def test_tile_angle_tolerance(self):
+        # Only the tiles merge segments with the angle tolerance
+        self.assertEqual(self.detect_key('--angle_tolerance', '10'), self.detect_key('--angle_tolerance', '2'))
+        self.assertNotEqual(self.detect_key('--tile', '512', '--angle_tolerance', '10'),
+                            self.detect_key('--tile', '512', '--angle_tolerance', '2'))
+
+class Test_new_frames(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, content):
+        with open(os.path.join(self.directory.name, name), 'wb') as file:
+            file.write(content)
+        return os.path.join(self.directory.name, name)
+
+    def test_only_complete_new_images(self):
+        seen, sizes = set(), {}
+        frame = self.write('frame_000.jpg', b'a')
+        self.write('frame_000_align.jpg', b'a')
+        self.write('notes.txt', b'a')
+        # The size is unknown in the first call, the image might still be written
+        self.assertEqual(cloudchamber.new_frames(self.directory.name, seen, sizes), [])
+
+        self.write('frame_001.jpg', b'a')
+        self.assertEqual(cloudchamber.new_frames(self.directory.name, seen, sizes), [frame])
+        seen.add(frame)
+
+        self.write('frame_001.jpg', b'ab')
+        self.assertEqual(cloudchamber.new_frames(self.directory.name, seen, sizes), [])
+        self.assertEqual(cloudchamber.new_frames(self.directory.name, seen, sizes),
+                         [os.path.join(self.directory.name, 'frame_001.jpg')])
+
+class Test_frames(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.frames = np.arange(4 * 6 * 8, dtype=np.uint8).reshape(4, 6, 8)
+
+    def tearDown(self):
+        frames.open_stack.cache_clear()
+        self.directory.cleanup()
+
+    def test_npy_view(self):
+        stack = os.path.join(self.directory.name, 'run.npy')
+        np.save(stack, self.frames)
+        names = frames.frame_names(stack, frames.parse_range('1:3'), None)
+        self.assertEqual(names, [stack + ':000001', stack + ':000002'])
+
+        frame = frames.read_frame(names[1], None)
+        self.assertEqual(frame.tolist(), self.frames[2].tolist())
+        # The frame is a view into the memory-mapped file, not a copy
+        self.assertIsInstance(frame.base, np.memmap)
+        self.assertFalse(frame.flags.writeable)
+
+    def test_raw(self):
+        stack = os.path.join(self.directory.name, 'run.raw')
+        self.frames.tofile(stack)
+        names = frames.frame_names(stack, frames.parse_range('::2'), (6, 8))
+        self.assertEqual([frames.parse_frame(x)[1] for x in names], [0, 2])
+        self.assertEqual(frames.read_frame(names[1], (6, 8)).tolist(), self.frames[2].tolist())
+        with self.assertRaises(ValueError):
+            frames.open_stack(stack, (5, 8))
+
+    def test_tiff(self):
+        stack = os.path.join(self.directory.name, 'run.tif')
+        cv2.imwritemulti(stack, list(self.frames))
+        self.assertEqual(len(frames.frame_names(stack, slice(None), None)), 4)
+        self.assertEqual(frames.read_frame(frames.frame_name(stack, 3), None).tolist(), self.frames[3].tolist())
+
+    def test_names(self):
+        self.assertEqual(frames.parse_frame('a/run.npy:000042'), ('a/run.npy', 42))
+        self.assertIsNone(frames.parse_frame('C:/run.jpg'))
+        self.assertEqual(frames.frame_path('a/run.npy:000042', '_align'), 'a/run_000042_align.jpg')
+        self.assertEqual(frames.parse_range('5'), slice(5, 6))
+
+class Test_codec(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_read_write(self):
+        image = np.zeros((96, 128), dtype=np.uint8)
+        cv2.line(image, (10, 80), (120, 10), 200, 5)
+        path = os.path.join(self.directory.name, 'a.jpg')
+        for name in codec.available():
+            codec.write(path, image, name, 95)
+            self.assertLess(np.abs(codec.read(path, name).astype(int) - image).mean(), 2, name)
+            self.assertEqual(codec.read(path, name, 4).shape, (24, 32), name)
+
+    def test_reduction(self):
+        self.assertEqual(codec.reduction(0.5), 2)
+        self.assertEqual(codec.reduction(0.3), 2)
+        self.assertEqual(codec.reduction(0.1), 8)
+        self.assertEqual(codec.reduction(2), 1)
+
+class Test_background(unittest.TestCase):
+    def test_static(self):
+        model = background.create('static', np.full((4, 4), 10, dtype=np.uint8), 100)
+        model.update(np.full((4, 4), 50, dtype=np.uint8))
+        self.assertEqual(model.prepared().tolist(), util.prepareBackground(np.full((4, 4), 10)).tolist())
+
+    def test_median_follows_lighting(self):
+        model = background.create('median', np.full((4, 4), 10, dtype=np.uint8), 100)
+        frame = np.full((4, 4), 30, dtype=np.uint8)
+        for number in range(40):
+            # A bright track in a few frames hardly moves the median
+            track = frame.copy()
+            if number % 10 == 0:
+                track[1] = 255
+            model.update(track)
+        self.assertEqual(model.prepared().tolist(), util.prepareBackground(frame).tolist())
+
+    def test_ema(self):
+        model = background.create('ema', np.full((4, 4), 10, dtype=np.uint8), 2)
+        model.update(np.full((4, 4), 30, dtype=np.uint8))
+        self.assertEqual(model.prepared().tolist(), util.prepareBackground(np.full((4, 4), 20)).tolist())
+
+class Test_tracks(unittest.TestCase):
+    def frame(self, name, points):
+        return util.LineSet.fromPoints(np.array(points).reshape(-1, 4), name)
+
+    def test_track_in_consecutive_frames(self):
+        tracker = tracks.Tracker(window=2, distance=20, angle_tolerance=10)
+        self.assertEqual(tracker.add(self.frame('0.jpg', [[100, 100, 500, 300], [1000, 100, 1000, 600]])), [])
+        # The first track is found shorter and a bit shifted, the second is not visible
+        self.assertEqual(tracker.add(self.frame('1.jpg', [[104, 101, 400, 250]])), [])
+        # A crossing line is a new track, the second track was not seen for two frames
+        ended = tracker.add(self.frame('2.jpg', [[100, 300, 500, 100]]))
+        self.assertEqual([track.id for track in ended], [1])
+        ended = tracker.add(self.frame('3.jpg', []))
+        self.assertEqual([track.id for track in ended], [0])
+        self.assertEqual((ended[0].first, ended[0].last, ended[0].frames), ('0.jpg', '1.jpg', 2))
+        self.assertEqual(ended[0].points, [100, 100, 500, 300])
+        self.assertEqual([track.id for track in tracker.finish()], [2])
+
+    def test_fragment_in_the_middle(self):
+        # No endpoint of the fragment is close to an endpoint of the track
+        tracker = tracks.Tracker()
+        tracker.add(self.frame('0.jpg', [[0, 0, 1000, 0]]))
+        tracker.add(self.frame('1.jpg', [[300, 2, 700, 2], [300, 60, 700, 60]]))
+        ended = tracker.finish()
+        self.assertEqual([(track.first, track.last, track.frames) for track in ended],
+                         [('0.jpg', '1.jpg', 2), ('1.jpg', '1.jpg', 1)])
+        self.assertEqual(ended[0].points, [0, 0, 1000, 0])
+
+    def test_tracksToLines(self):
+        tracker = tracks.Tracker()
+        tracker.add(self.frame('0.jpg', [[0, 0, 100, 0]]))
+        tracker.add(self.frame('1.jpg', [[0, 0, 100, 0], [0, 50, 0, 200]]))
+        lines = tracks.tracksToLines(tracker.finish())
+        self.assertEqual(lines.filenames, ['0.jpg', '1.jpg'])
+        self.assertEqual(lines.points.tolist(), [[0, 0, 100, 0], [0, 50, 0, 200]])
+
+    def test_writeTracks(self):
+        # Both tracks appear in the first frame, but the second ends long after the first
+        frames = [self.frame('f000.jpg', [[0, 0, 100, 0], [500, 500, 900, 500]])]
+        frames += [self.frame('f%03d.jpg' % i, [[500, 500, 900, 500]]) for i in range(1, 6)]
+        frames += [self.frame('f%03d.jpg' % i, []) for i in range(6, 8)]
+        with tempfile.TemporaryDirectory() as folder:
+            output = LineStore(os.path.join(folder, 'tracks'))
+            csv = os.path.join(folder, 'tracks.csv')
+            self.assertEqual(tracks.writeTracks(frames, tracks.Tracker(), output, csv), 8)
+            for store in [output, LineStore(output.path)]:
+                lines = store.read()
+                self.assertEqual(lines.filenames, ['f000.jpg'])
+                self.assertEqual(sorted(lines.points.tolist()), [[0, 0, 100, 0], [500, 500, 900, 500]])
+            with open(csv) as file:
+                self.assertEqual(len(file.readlines()), 3)  # Header and two tracks
+
+class Test_sweep(unittest.TestCase):
+    def test_parse_grid(self):
+        grid = sweep.parse_grid(['canny=20:40,30:60', 'threshold=5'])
+        self.assertEqual(grid, {'canny': ['20:40', '30:60'], 'threshold': ['5']})
+        with self.assertRaises(ValueError):
+            sweep.parse_grid(['cache=a'])
+
+        configurations = sweep.configurations(grid, ['--align', 'none'])
+        self.assertEqual([options.canny for options in configurations], [[20, 40], [30, 60]])
+        self.assertEqual(configurations[0].align, 'none')
+
+    def test_same_as_pipeline(self):
+        image = os.path.join(directory, 'example_data', 'Nebelkammer_000.jpg')
+        grid = sweep.parse_grid(['threshold=5,8', 'hough_threshold=10,20', 'angle_tolerance=10'])
+        configurations = sweep.configurations(grid, ['--align', 'none', '--roi', 'auto'])
+        rows = sweep.sweep_image(image, configurations)
+
+        for options, row in zip(configurations, rows):
+            cloudchamber.configure(options)
+            lines = cloudchamber.detect_line(cloudchamber.remove_background(cloudchamber.read_image(image)), image)
+            self.assertEqual(row['lines_unfiltered'], len(lines))
+            self.assertEqual(row['lines_filtered'], len(cloudchamber.filter_line(lines)))
+
+class Test_service(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_request(self):
+        def respond(request):
+            if 'images' in request:
+                return {'results': [{'image': image, 'lines': [[0, 0, 1, 1]]} for image in request['images']]}
+            raise ValueError('unknown request')
+
+        path = os.path.join(self.directory.name, 'cloudchamber.sock')
+        with service.Server(path, respond) as server:
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                results = service.submit(path, ['a.jpg'])
+                self.assertEqual(results, [{'image': os.path.abspath('a.jpg'), 'lines': [[0, 0, 1, 1]]}])
+                with self.assertRaises(RuntimeError):
+                    service.status(path)
+            finally:
+                server.shutdown()
+                thread.join()
+        self.assertFalse(os.path.exists(path))
+
+class Test_pipeline(unittest.TestCase):
+    def test_order_and_batches(self):
+        read, batches = [], []
+        with ThreadPoolExecutor(3) as pool:
+            pipeline.run(range(20), read.append, lambda item: pool.submit(lambda: item * item).result,
+                         batches.append, readers=2, depth=4, batch=5)
+        self.assertEqual(sorted(read), list(range(20)))
+        self.assertTrue(all(1 <= len(batch) <= 5 for batch in batches))
+        self.assertEqual([entry for batch in batches for entry in batch], [(i, i * i) for i in range(20)])
+
+    def test_read_ahead_bounded(self):
+        # The readers must not run ahead of a computation that waits
+        read = []
+        release = threading.Event()
+
+        def submit(item):
+            return lambda: release.wait() and item
+
+        thread = threading.Thread(target=pipeline.run, args=(range(100), read.append, submit, lambda entries: None, 2, 4, 2))
+        thread.start()
+        try:
+            thread.join(0.5)
+            # depth items are read, depth wait for the writer, batch are written and one waits to be queued
+            self.assertLessEqual(len(read), 4 + 4 + 2 + 1)
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(len(read), 100)
+
+    def test_error(self):
+        def submit(item):
+            if item == 3:
+                raise ValueError('broken image')
+            return lambda: item
+
+        with self.assertRaises(ValueError):
+            pipeline.run(range(10), lambda item: None, submit, lambda entries: None)
+
+        def write(entries):
+            raise IOError('disk full')
+
+        with self.assertRaises(IOError):
+            pipeline.run(range(10), lambda item: None, lambda item: lambda: item, write)
+
+class Test_detectors(unittest.TestCase):
+    def test_find_track(self):
+        image = np.zeros((768, 1152), dtype=np.uint8)
+        cv2.line(image, (200, 600), (900, 250), 120, 5)
+        for detector in DETECTORS:
+            options = cloudchamber.parse_args(['--detector', detector, 'a.jpg'])
+            lines = util.filterLines(util.LineSet.fromPoints(DETECTORS[detector](image, options), 'a.jpg'))
+            self.assertGreater(len(lines), 0, detector)
+            # The longest line lies on the track, lsd finds the edges of the track in the downsampled image
+            longest = lines.points[np.argmax(lines.length)]
+            self.assertGreater(lines.length.max(), 600, detector)
+            for x, y in longest.reshape(2, 2):
+                distance = abs((y - 600) + (x - 200) * 0.5) / np.hypot(1, 0.5)
+                self.assertLess(distance, 10, detector)
+
+    def test_tiles_cover_image(self):
+        covered = np.zeros((700, 1000), dtype=int)
+        for box in detectors.tiles(covered.shape, 256, 16):
+            covered[box] += 1
+        self.assertTrue((covered >= 1).all())
+
+    def test_tiled_track_across_seams(self):
+        image = np.zeros((768, 1152), dtype=np.uint8)
+        cv2.line(image, (100, 700), (1000, 100), 120, 5)
+        options = cloudchamber.parse_args(['--tile', '256', '--tile_threads', '2', 'a.jpg'])
+        lines = util.filterLines(util.LineSet.fromPoints(detectors.detect(image, options), 'a.jpg'))
+        # The pieces of the tiles are merged into one line
+        self.assertEqual(len(lines), 1)
+        self.assertGreater(lines.length[0], 1000)
+
+    def test_box(self):
+        image = np.zeros((768, 1152), dtype=np.uint8)
+        cv2.line(image, (500, 200), (500, 600), 120, 5)
+        options = cloudchamber.parse_args(['a.jpg'])
+        points = detectors.detect(image, options, (slice(100, 700), slice(400, 700)))
+        self.assertEqual(points.tolist(), detectors.detect(image, options).tolist())
+
+class Test_compose_result(unittest.TestCase):
+    def test_grid(self):
+        panels = [np.full((300, 400), value, dtype=np.uint8) for value in [10, 20, 30, 40]]
+        result = cloudchamber.compose_result(panels, cloudchamber.result_titles(12, 3), 0.5)
+
+        band = (result.shape[0] - 300) // 2
+        self.assertEqual(result.shape, (2 * (band + 150), 400))
+        self.assertEqual(result[band:band + 150, :200].tolist(), panels[0][::2, ::2].tolist())
+        self.assertEqual(result[-1, -1], 40)
+        # The titles are written in black on the white bands
+        self.assertEqual(result[:band].max(), 255)
+        self.assertEqual(result[:band].min(), 0)
+
+    def test_color(self):
+        panels = [np.full((300, 400), 10, dtype=np.uint8)] * 2 + [np.full((150, 200, 3), (0, 0, 255), dtype=np.uint8)] * 2
+        result = cloudchamber.compose_result(panels, cloudchamber.result_titles(12, 3), 0.5)
+
+        self.assertEqual(result.shape[2], 3)
+        self.assertEqual(result[-1, -1].tolist(), [0, 0, 255])
+        self.assertEqual(result[result.shape[0] // 2 - 1, 0].tolist(), [10, 10, 10])
+
+class Test_colorImageWithLines(unittest.TestCase):
+    def setUp(self):
+        self.image = np.full((200, 300), 20, dtype=np.uint8)
+        # A horizontal and a vertical line, which get different colors
+        self.lines = util.LineSet([10, 150], [50, 10], [140, 150], [50, 190], [0, 0], ['a.jpg'])
+
+    def test_colors(self):
+        overlay = util.colorImageWithLines(self.lines, self.image)
+        self.assertEqual(overlay.shape, (200, 300, 3))
+        self.assertEqual(self.image.max(), 20)  # The image is not changed
+        self.assertEqual(overlay[50, 70].tolist(), util.LINE_COLORS[0])
+        self.assertNotEqual(overlay[100, 150].tolist(), overlay[50, 70].tolist())
+        self.assertEqual(overlay[150, 70].tolist(), [20, 20, 20])
+        # The colors depend only on the angles
+        self.assertEqual(overlay.tolist(), util.colorImageWithLines(self.lines, self.image).tolist())
+
+    def test_scale(self):
+        overlay = util.colorImageWithLines(self.lines, self.image, 0.5)
+        self.assertEqual(overlay.shape, (100, 150, 3))
+        self.assertEqual(overlay[25, 35].tolist(), util.LINE_COLORS[0])
+
+    def test_no_lines(self):
+        lines = util.LineSet([], [], [], [], [], ['a.jpg'])
+        self.assertEqual(util.colorImageWithLines(lines, self.image).tolist(), cv2.cvtColor(self.image, cv2.COLOR_GRAY2BGR).tolist())
+
+class Test_metrics(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        metrics.collect()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_record(self):
+        @metrics.step
+        def compute(x):
+            return x + 1
+
+        @metrics.measure
+        def stage(image):
+            with metrics.timer('decode'):
+                x = 1
+            metrics.annotate(lines_unfiltered=3)
+            return compute(x)
+
+        self.assertEqual(stage('a.jpg'), 2)
+        records = metrics.collect()
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['stage'], 'stage')
+        self.assertEqual(records[0]['image'], 'a.jpg')
+        self.assertEqual(records[0]['lines_unfiltered'], 3)
+        self.assertEqual(list(records[0]['steps']), ['compute'])
+        self.assertAlmostEqual(records[0]['seconds'], records[0]['decode'] + records[0]['compute'] + records[0]['encode'])
+        self.assertEqual(metrics.collect(), [])
+
+    def test_apply_failed(self):
+        @metrics.measure
+        def stage(image):
+            if image == 'missing.jpg':
+                raise IOError('Cannot read the image ' + image)
+            return image
+
+        with self.assertRaises(IOError):
+            cloudchamber.apply(stage, ('missing.jpg',))
+        result, records = cloudchamber.apply(stage, ('a.jpg',))
+        self.assertEqual(result, 'a.jpg')
+        self.assertEqual([record['image'] for record in records], ['a.jpg'])
+
+    def test_prometheus(self):
+        path = os.path.join(self.directory.name, 'metrics.prom')
+        sink = metrics.PrometheusSink(path)
+        for lines in [3, 4]:
+            sink.write({'stage': 'process_image', 'decode': 0.5, 'compute': 1.0, 'encode': 0.0,
+                        'steps': {'detect_line': 0.25}, 'lines_unfiltered': lines, 'peak_rss': 100})
+        sink.close()
+
+        with open(path) as file:
+            text = file.read()
+        self.assertIn('cloudchamber_frames_total{stage="process_image"} 2\n', text)
+        self.assertIn('cloudchamber_stage_seconds_total{stage="process_image",phase="decode"} 1.0\n', text)
+        self.assertIn('cloudchamber_step_seconds_total{step="detect_line"} 0.5\n', text)
+        self.assertIn('cloudchamber_lines_total{kind="unfiltered"} 7\n', text)
+        self.assertIn('cloudchamber_peak_rss_bytes 100\n', text)
+
+class Test_plot(unittest.TestCase):
+    def test_removePicturesWithTooManyLines(self):
+        lengths = np.array([1.0, 2.0, 3.0, 4.0, 5.0])
+        imageIds = np.array([0, 1, 1, 2, 1])
+        self.assertEqual(plot.removePicturesWithTooManyLines(lengths, imageIds, 2).tolist(), [1.0, 4.0])
+
+    def test_loadCSV_swapped_columns(self):
+        # Older versions wrote the angle into the column length
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'lines.csv')
+            with open(path, 'w') as file:
+                file.write('filename,length,angle,p1_x,p1_y,p2_x,p2_y\n'
+                           'a.jpg,90.0,30.0,0,0,0,30\n'
+                           'a.jpg,0.0,4.0,0,0,4,0\n'
+                           'b.jpg,36.87,5.0,0,0,4,3\n')
+            lengths, imageIds = plot.loadCSV(path)
+        self.assertEqual(lengths.tolist(), [30.0, 4.0, 5.0])
+        self.assertEqual(imageIds.tolist(), [0, 0, 1])
+
+    def test_betheBloch_same_as_scalar(self):
+        lengths = np.array([10.0, 40.0, 55.5])
+        expected = [math.sqrt(plot.Z**2 * plot.n * plot.Z_strich * plot.e**4 * plot.m_alpha / 4 / math.pi / plot.epsilon_0**2
+                              / plot.m_e * length * 10**(-3)) / plot.e / 10**6 for length in lengths]
+        np.testing.assert_allclose(plot.betheBloch(lengths), expected)
+
+class Test_Aligner(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.background = imageio.imread(os.path.join(directory, 'background', 'background.jpg'), pilmode='L')
+        cls.image = imageio.imread(os.path.join(directory, 'example_data', 'Nebelkammer_000.jpg'), pilmode='L')
+
+    def transform(self, image, angle, scale, shift):
+        height, width = image.shape
+        matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, scale)
+        matrix[:, 2] += shift
+        return matrix, cv2.warpAffine(image, matrix, (width, height), borderMode=cv2.BORDER_REPLICATE)
+
+    def test_known_transforms(self):
+        aligner = Aligner(self.background)
+        height, width = self.background.shape
+        corners = np.array([[0, 0, 1], [width, 0, 1], [0, height, 1], [width, height, 1]])
+        for angle, scale, shift in [(0, 1, (20, -12)), (-1.5, 1.02, (-30, 8)), (3, 0.98, (11.5, -7.25))]:
+            matrix, image = self.transform(self.background, angle, scale, shift)
+            estimated = aligner.estimate(image)
+            # Estimated transform after the known transform should move the corners back
+            combined = np.vstack([estimated, [0, 0, 1]]) @ np.vstack([matrix, [0, 0, 1]])
+            self.assertLess(np.abs(corners @ combined[:2].T - corners[:, :2]).max(), 3)
+
+    def test_aligned_image_is_not_copied(self):
+        aligner = Aligner(self.background)
+        self.assertIs(aligner.align(self.background), self.background)
+
+    def test_as_accurate_as_imreg_dft(self):
+        # imreg_dft is too slow for the full resolution, both work on the same small images
+        background = cv2.resize(self.background, (576, 384), interpolation=cv2.INTER_AREA)
+        image = cv2.resize(self.image, (576, 384), interpolation=cv2.INTER_AREA)
+        aligner = Aligner(background, downscale=1, refine_size=0)
+        inner = (slice(40, -40), slice(40, -40))
+        for angle, scale, shift in [(1.5, 1.01, (6, -4)), (-2.5, 0.99, (-3.5, 2))]:
+            _, transformed = self.transform(image, angle, scale, shift)
+            error_fast = np.abs(np.float64(aligner.align(transformed)[inner]) - background[inner]).mean()
+            error_exact = np.abs(ird.similarity(np.float64(background), np.float64(transformed), numiter=3)['timg'][inner] - background[inner]).mean()
+            self.assertLess(error_fast, error_exact * 1.1)
+
+class Test_subtractBackground(unittest.TestCase):
+    def subtractBackgroundPerPixel(self, image, background):
+        '''Previous implementation, used as reference'''
+        image = np.int16(image) - np.int16(background) * 2
+        for x, y in zip(np.where(image < 5)[0], np.where(image < 5)[1]):
+            image[x, y] = 0
+        return np.uint8(image)
+
+    def test_example_data(self):
+        background = imageio.imread(os.path.join(directory, 'background', 'background_with_stripes.jpg'), pilmode='L')
+        preparedBackground = util.prepareBackground(background)
+        for name in ['Nebelkammer_000.jpg', 'Nebelkammer_000_align.jpg']:
+            image = imageio.imread(os.path.join(directory, 'example_data', name), pilmode='L')
+            result = util.subtractBackground(image, preparedBackground)
+            self.assertEqual(result.dtype, np.uint8)
+            np.testing.assert_array_equal(result, self.subtractBackgroundPerPixel(image, background))
+
+    def test_threshold(self):
+        image = np.array([[0, 4, 5, 255]], dtype=np.uint8)
+        background = util.prepareBackground(np.zeros_like(image))
+        np.testing.assert_array_equal(util.subtractBackground(image, background), [[0, 0, 5, 255]])
+
+class Test_mergeLines(unittest.TestCase):
+    def connectLinesReference(self, lines, angle_tolerance):
+        '''Previous implementation, used as reference'''
+        lines = list(lines)
+        while util.connectTwoLinesIfPossible(lines, angle_tolerance):
+            pass
+        return lines
+
+    def createCorpus(self, seed, numberOfLines):
+        '''Tracks with a similar angle split into fragments, plus short noise lines'''
+        rng = np.random.default_rng(seed)
+        angle = rng.uniform(-180, 180)
+        lines = []
+        for _ in range(max(1, numberOfLines // 6)):
+            (x, y), direction = rng.uniform(0, 2000, 2), np.radians(angle + rng.normal(0, 4))
+            cuts = np.sort(rng.uniform(0, rng.uniform(200, 1500), 6))
+            for start, end in zip(cuts[:-1], cuts[1:]):
+                jitter = rng.normal(0, 3, 4)
+                lines.append(util.Line(int(x + start * np.cos(direction) + jitter[0]), int(y + start * np.sin(direction) + jitter[1]),
+                                       int(x + end * np.cos(direction) + jitter[2]), int(y + end * np.sin(direction) + jitter[3]), 'Testfile.jpg'))
+        while len(lines) < numberOfLines:
+            (x, y), direction = rng.uniform(0, 2000, 2), np.radians(angle + rng.normal(0, 6) + 180 * rng.integers(2))
+            length = rng.uniform(5, 300)
+            lines.append(util.Line(int(x), int(y), int(x + length * np.cos(direction)), int(y + length * np.sin(direction)), 'Testfile.jpg'))
+        rng.shuffle(lines)
+        return lines
+
+    def test_no_line(self):
+        self.assertEqual(len(util.mergeLines(util.LineSet.fromLines([]), 10)), 0)
+
+    def test_same_as_reference(self):
+        for seed in range(60):
+            lines = self.createCorpus(seed, 5 + seed % 40)
+            expected = self.connectLinesReference(lines, 10)
+            merged = util.mergeLines(util.LineSet.fromLines(lines), 10, sameDirection=False)
+            self.assertEqual(merged.points.tolist(), [list(line.getPoints()) for line in expected])
+            np.testing.assert_array_equal(merged.angle, [line.angle for line in expected])
+
+    def test_intermediate_angles_do_not_join(self):
+        # Segments at 8, 16 ... 88 degree elsewhere in the image must not connect two perpendicular lines
+        pair = [[0, 0, 100, 0], [105, 0, 105, 100]]
+        between = [[2000, 100 * k, 2000 + int(50 * np.cos(np.radians(8 * k))), 100 * k + int(50 * np.sin(np.radians(8 * k)))]
+                   for k in range(1, 12)]
+        for points in [pair, pair + between]:
+            lines = util.filterLines(util.LineSet.fromPoints(np.array(points), 'a.jpg'), 10)
+            for line in pair:
+                self.assertIn(line, lines.points.tolist())
+
+        # The previous behaviour compared only the first line with the connection and joined them in one group
+        lines = util.mergeLines(util.LineSet.fromPoints(np.array(pair + between), 'a.jpg'), 10, sameDirection=False)
+        self.assertIn([0, 0, 105, 100], lines.points.tolist())
+
+    def test_fragments_with_other_lines(self):
+        # Two fragments of one track at 9.87 and 10.26 degree are connected, also next to an unrelated line at 0 degree
+        fragments = [[0, 0, 500, 87], [520, 90, 1000, 177]]
+        other = [[3000, 3000, 3200, 3000]]
+        for points in [fragments + other, fragments[::-1] + other, other + fragments]:
+            lines = util.filterLines(util.LineSet.fromPoints(np.array(points), 'a.jpg'), 10)
+            segments = {tuple(sorted([tuple(line[:2]), tuple(line[2:])])) for line in lines.points.tolist()}
+            self.assertEqual(segments, {((0, 0), (1000, 177)), ((3000, 3000), (3200, 3000))})
+
+    def test_filterLines_pool(self):
+        from concurrent.futures import ThreadPoolExecutor
+        lines = util.LineSet.fromLines(self.createCorpus(0, 60))
+        with ThreadPoolExecutor(2) as pool:
+            self.assertEqual(util.filterLines(lines, 10, pool).points.tolist(), util.filterLines(lines, 10).points.tolist())
+
+    def test_gridPairs_contains_close_pairs(self):
+        rng = np.random.default_rng(0)
+        points = rng.integers(0, 1000, (50, 4))
+        first, second = util.gridPairs(points, 100)
+        pairs = set(zip(first.tolist(), second.tolist()))
+        for i in range(len(points)):
+            for j in range(i + 1, len(points)):
+                endpoints_i, endpoints_j = points[i].reshape(2, 2), points[j].reshape(2, 2)
+                distance = min(np.linalg.norm(a - b) for a in endpoints_i for b in endpoints_j)
+                if distance <= 100:
+                    self.assertIn((i, j), pairs)
+
+    def test_closePairs_contains_close_pairs(self):
+        rng = np.random.default_rng(0)
+        start = rng.integers(0, 1000, (80, 2))
+        points = np.concatenate([start, start + rng.integers(-300, 300, (80, 2))], axis=1)
+        lengths = util.lengths(*points.T)
+        first, second = util.closePairs(points, lengths)
+        pairs = set(zip(first.tolist(), second.tolist()))
+        for i in range(len(points)):
+            for j in range(i + 1, len(points)):
+                endpoints_i, endpoints_j = points[i].reshape(2, 2), points[j].reshape(2, 2)
+                distance = min(np.linalg.norm(a - b) for a in endpoints_i for b in endpoints_j)
+                if distance <= (lengths[i] + lengths[j]) / 4:
+                    self.assertIn((i, j), pairs)
+
+    def test_closePairs_long_line(self):
+        # A long track must not make the grid of the short noise lines coarse
+        rng = np.random.default_rng(0)
+        start = rng.integers(0, 4000, (3000, 2))
+        points = np.concatenate([start, start + rng.integers(-20, 20, (3000, 2))], axis=1)
+        points[0] = [0, 0, 3000, 2000]
+        first, _ = util.closePairs(points, util.lengths(*points.T))
+        self.assertLess(len(first), 20000)
 
 #class Test_filterLines(unittest.TestCase):
 #    def test_two_values(self):
@@ -0,0 +1,180 @@
+'''Tracks across frames: a track which is visible in several consecutive frames is counted only once.
+
+The filtered lines of the frames are added one frame after the other. A line continues an open track, if they have a
+similar direction and lie on each other; the candidates are found with util.gridNeighbours on points along the lines.
+A track ends when it was not seen for window frames, then it is returned with the longest line it had. Only the open
+tracks are kept, so the memory depends on the window, not on the number of frames.'''
+import numpy as np
+from argparse import ArgumentParser
+
+import util  # Selfmade library
+from store import LineStore
+
+class Track:
+    def __init__(self, id, points, filename, number):
+        self.id = id
+        self.points = points    # The longest line of the track
+        self.first = filename   # Frame in which the track appeared first
+        self.last = filename    # Frame in which the track was seen last
+        self.number = number    # Position of the frame self.last in the sequence
+        self.frames = 1
+
+    @property
+    def length(self):
+        return util.length(*self.points)
+
+class Tracker:
+    def __init__(self, window=3, distance=20, angle_tolerance=10):
+        self.window = window
+        self.distance = distance
+        self.angle_tolerance = angle_tolerance
+        self.open = []      # Tracks seen in the last window frames, ordered by id
+        self.next_id = 0
+        self.number = -1    # Position of the last added frame in the sequence
+
+    def add(self, lines):
+        '''Adds the lines of the next frame, returns the tracks that ended'''
+        self.number += 1
+        filename = lines.filenames[0]
+        points = lines.points.astype(np.int64)
+        matches = self.match(points)
+
+        for i, track in zip(range(len(points)), matches):
+            if track is None:
+                self.open.append(Track(self.next_id, points[i].tolist(), filename, self.number))
+                self.next_id += 1
+                continue
+            if track.number != self.number:
+                track.frames += 1
+            track.last, track.number = filename, self.number
+            if lines.length[i] > track.length:
+                track.points = points[i].tolist()
+
+        ended = [track for track in self.open if self.number - track.number >= self.window]
+        self.open = [track for track in self.open if self.number - track.number < self.window]
+        return ended
+
+    def finish(self):
+        '''Returns the tracks that are still open, at the end of the sequence'''
+        ended, self.open = self.open, []
+        return ended
+
+    def match(self, points):
+        '''Returns for every line the open track it continues or None.
+           A line continues the track with the smallest distance between their lines.'''
+        matches = [None] * len(points)
+        if not self.open or not len(points):
+            return matches
+
+        tracks = np.array([track.points for track in self.open], dtype=np.int64)
+        # Pairs of an open track and a line of the new frame, which come closer than distance somewhere along the lines.
+        # The sampled points are at most distance apart, so the closest points of two such lines are in neighbouring cells.
+        trackSamples, trackOwners = samplePoints(tracks, self.distance)
+        lineSamples, lineOwners = samplePoints(points, self.distance)
+        first, second = util.gridNeighbours(trackSamples, lineSamples, 2 * self.distance)
+        pairs = np.unique(trackOwners[first] * len(points) + lineOwners[second])
+        first, second = pairs // len(points), pairs % len(points)
+
+        difference = np.abs(util.anglesBetween(*tracks[first].T) - util.anglesBetween(*points[second].T)) % 180
+        similar = np.minimum(difference, 180 - difference) <= self.angle_tolerance
+        distance = np.maximum(pointLineDistances(tracks[first], points[second]), pointLineDistances(points[second], tracks[first]))
+        close = similar & (distance <= self.distance)
+
+        # The closest track first, for equal distances the older track
+        order = np.lexsort((first[close], distance[close]))
+        for i_track, i_line in zip(first[close][order].tolist(), second[close][order].tolist()):
+            if matches[i_line] is None:
+                matches[i_line] = self.open[i_track]
+        return matches
+
+def samplePoints(lines, spacing):
+    '''Returns points along the lines, including the endpoints, at most spacing apart, and for every pair of points its
+       line. Every line has an even number of points, so that the pairs are lines for util.gridNeighbours.'''
+    x1, y1, x2, y2 = lines.T.astype(np.float64)
+    counts = 2 * (np.ceil(np.hypot(x2 - x1, y2 - y1) / spacing).astype(np.int64) // 2 + 1)
+    owners = np.repeat(np.arange(len(lines)), counts)
+    # Position of every point on its line from 0 to 1
+    t = (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)) / (counts - 1)[owners]
+    samples = np.stack([x1[owners] + t * (x2 - x1)[owners], y1[owners] + t * (y2 - y1)[owners]], axis=1)
+    return samples.reshape(-1, 4), owners[::2]
+
+def pointLineDistances(lines, others):
+    '''Returns the distances of the centres of the other lines to the lines, measured perpendicular to the lines'''
+    x1, y1, x2, y2 = lines.T.astype(np.float64)
+    centres = (others[:, :2] + others[:, 2:]) / 2
+    lengths = np.maximum(np.hypot(x2 - x1, y2 - y1), 1)
+    return np.abs((x2 - x1) * (y1 - centres[:, 1]) - (x1 - centres[:, 0]) * (y2 - y1)) / lengths
+
+def tracksToLines(tracks):
+    '''Returns the longest line of every track as LineSet, assigned to the frame in which the track appeared first'''
+    filenames = list(dict.fromkeys(track.first for track in tracks))
+    points = np.array([track.points for track in tracks], dtype=np.int32).reshape(-1, 4)
+    frame = [filenames.index(track.first) for track in tracks]
+    return util.LineSet(*points.T, frame, filenames)
+
+def tracksToDataFrame(tracks):
+    '''Returns one row per track with the columns of the lines and its id, its last frame and the number of frames.
+       The filename is the first frame, so that plot.py reads the file like the lines of the images.'''
+    df = tracksToLines(tracks).toDataFrame()
+    df['id'] = [track.id for track in tracks]
+    df['last'] = [track.last for track in tracks]
+    df['frames'] = [track.frames for track in tracks]
+    return df
+
+def readFrames(store, batch):
+    '''Yields the lines of every image of the store in the order of the filenames, batch images are read at once'''
+    filenames = sorted(store.filenames())
+    for start in range(0, len(filenames), batch):
+        yield from store.read(filenames[start:start + batch]).splitByFilename()
+
+def writeTracks(frames, tracker, output, csv=None):
+    '''Adds the lines of the frames to the tracker and appends the ended tracks to the store output, returns the
+       number of frames. A track is stored under the frame in which it appeared first and the store replaces the
+       lines of a frame that is appended again, so the tracks of a frame are appended together, once none is open.'''
+    ended = {}  # Frame in which the tracks appeared first -> tracks that ended
+    written = 0
+
+    def write(tracks, finished=False):
+        nonlocal written
+        for track in tracks:
+            ended.setdefault(track.first, []).append(track)
+        # A frame can only get new tracks while it is the first frame of an open track
+        starting = set() if finished else {track.first for track in tracker.open}
+        tracks = []
+        for first in [first for first in ended if first not in starting]:
+            tracks += ended.pop(first)
+        if not tracks:
+            return
+        tracks.sort(key=lambda track: track.id)
+        output.append(tracksToLines(tracks))
+        if csv:
+            tracksToDataFrame(tracks).to_csv(csv, mode='a' if written else 'w', header=not written, index=False)
+        written += len(tracks)
+
+    number = 0
+    for lines in frames:
+        write(tracker.add(lines))
+        number += 1
+    write(tracker.finish(), finished=True)
+    return number
+
+def main():
+    parser = ArgumentParser(description="Joins the lines of consecutive frames to tracks, so that every track is counted once")
+    parser.add_argument('input', nargs='?', default='lines_filtered', help='folder of the store with the filtered lines')
+    parser.add_argument('-o', '--output', default='tracks', help='folder of the store with the longest line of every track')
+    parser.add_argument('--csv', metavar='FILE', help='also export the tracks with their ids and frames as CSV file')
+    parser.add_argument('--window', type=int, default=3, metavar='FRAMES', help='a track ends when it was not seen for this number of frames')
+    parser.add_argument('--distance', type=float, default=20, metavar='PIXELS', help='maximal distance of a line to the track it continues')
+    parser.add_argument('--angle_tolerance', type=float, default=10, help='maximal difference of the angles of a line and its track in degree')
+    parser.add_argument('--batch', type=int, default=100, metavar='IMAGES', help='number of images read from the store at once')
+    args = parser.parse_args()
+
+    output = LineStore(args.output)
+    output.clear()
+    tracker = Tracker(args.window, args.distance, args.angle_tolerance)
+    frames = writeTracks(readFrames(LineStore(args.input), args.batch), tracker, output, args.csv)
+    output.compact()
+    print('%d tracks in %d frames' % (tracker.next_id, frames))
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,9 @@
 import numpy as np
 import os
 import math
+import heapq
+import functools
 import cv2
-from random import randint
-import pandas
 
 ##################################################
 #                     Class                      #
@@ -22,41 +22,189 @@ class Line:
     def getPoints(self):
         return(self.x1, self.y1, self.x2, self.y2)
 
-def createLinesWithClass(lines, filename):
-    '''Transforms an array of full points into an array with the lines'''
-    tmpLines = []
-    for line in lines:
-        (x1, y1, x2, y2) = line
-        tmpLines.append(Line(x1, y1, x2, y2, filename))
-    return tmpLines
-
-def linesToDataFrame(lines):
-    tmp = {'filename':[], 'length':[] ,'angle':[] ,'p1_x':[] ,'p1_y':[] ,'p2_x':[] ,'p2_y':[]}
-    for line in lines:
-        tmp['filename'].append(line.filename)
-        tmp['length'].append(line.length)
-        tmp['angle'].append(line.angle)
-        tmp['p1_x'].append(line.x1)
-        tmp['p1_y'].append(line.y1)
-        tmp['p2_x'].append(line.x2)
-        tmp['p2_y'].append(line.y2)
-
-    return pandas.DataFrame(tmp)
+class LineSet:
+    '''The lines of one or more images, stored column by column in NumPy arrays.
+       frame is the index of the filename of each line in filenames.'''
+    columns = ['x1', 'y1', 'x2', 'y2', 'frame', 'length', 'angle']
+
+    def __init__(self, x1, y1, x2, y2, frame, filenames, length=None, angle=None):
+        self.x1 = np.asarray(x1, dtype=np.int32)
+        self.y1 = np.asarray(y1, dtype=np.int32)
+        self.x2 = np.asarray(x2, dtype=np.int32)
+        self.y2 = np.asarray(y2, dtype=np.int32)
+        self.frame = np.asarray(frame, dtype=np.int32)
+        self.filenames = list(filenames)
+        self.length = lengths(self.x1, self.y1, self.x2, self.y2) if length is None else np.asarray(length, dtype=np.float64)
+        self.angle = anglesBetween(self.x1, self.y1, self.x2, self.y2) if angle is None else np.asarray(angle, dtype=np.float64)
+
+    @classmethod
+    def fromPoints(cls, points, filename):
+        '''Creates the lines of one image from an array with the points of each line, e.g. from cv2.HoughLinesP'''
+        points = np.zeros((0, 4), dtype=np.int32) if points is None else np.asarray(points).reshape(-1, 4)
+        return cls(*points.T, np.zeros(len(points), dtype=np.int32), [filename])
+
+    @classmethod
+    def fromLines(cls, lines):
+        '''Creates the lines from a list of Line objects'''
+        filenames = list(dict.fromkeys(line.filename for line in lines))
+        frame = [filenames.index(line.filename) for line in lines]
+        points = np.array([line.getPoints() for line in lines], dtype=np.int32).reshape(-1, 4)
+        return cls(*points.T, frame, filenames)
+
+    @classmethod
+    def fromDataFrame(cls, df):
+        '''Creates the lines from a DataFrame as written by toDataFrame, the coordinates are not copied if they are int32.
+           Length and angle are calculated again, because CSV files of older versions have swapped these columns.'''
+        import pandas  # Imported only when needed, it slows down the start of the program
+        frame, filenames = pandas.factorize(df['filename'], sort=True)
+        return cls(df['p1_x'].to_numpy(), df['p1_y'].to_numpy(), df['p2_x'].to_numpy(), df['p2_y'].to_numpy(), frame, filenames)
+
+    @staticmethod
+    def concatenate(lineSets, filenames=None):
+        '''Joins several sets of lines into one'''
+        if filenames is None:
+            filenames = list(dict.fromkeys(filename for lineSet in lineSets for filename in lineSet.filenames))
+        index = {filename: i for i, filename in enumerate(filenames)}
+        frames = [np.array([index[filename] for filename in lineSet.filenames], dtype=np.int32)[lineSet.frame] for lineSet in lineSets]
+
+        columns = [np.concatenate([getattr(lineSet, column) for lineSet in lineSets] + [np.zeros(0)]) for column in ['x1', 'y1', 'x2', 'y2', 'length', 'angle']]
+        return LineSet(*columns[:4], np.concatenate(frames + [np.zeros(0)]), filenames, length=columns[4], angle=columns[5])
+
+    def __len__(self):
+        return len(self.x1)
+
+    def __getitem__(self, index):
+        '''Selects lines with an index array, a boolean mask or a slice'''
+        return LineSet(self.x1[index], self.y1[index], self.x2[index], self.y2[index], self.frame[index], self.filenames,
+                       length=self.length[index], angle=self.angle[index])
+
+    @property
+    def points(self):
+        '''The points of the lines as array with the columns x1, y1, x2, y2'''
+        return np.stack([self.x1, self.y1, self.x2, self.y2], axis=1)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, column).nbytes for column in self.columns)
+
+    def splitByFilename(self):
+        '''Returns a set of lines for every filename, also for images without lines, in the order of the filenames'''
+        order = np.argsort(self.frame, kind='stable')
+        bounds = np.searchsorted(self.frame[order], np.arange(len(self.filenames) + 1))
+        lineSets = []
+        for filename, start, end in zip(self.filenames, bounds[:-1], bounds[1:]):
+            lines = self[order[start:end]]
+            lineSets.append(LineSet(lines.x1, lines.y1, lines.x2, lines.y2, np.zeros(len(lines)), [filename],
+                                    length=lines.length, angle=lines.angle))
+        return lineSets
+
+    def toDataFrame(self):
+        '''Returns the lines as DataFrame with the columns of the CSV files, the numeric columns are not copied'''
+        import pandas
+        return pandas.DataFrame({
+            'filename': pandas.Categorical.from_codes(self.frame, categories=pandas.Index(self.filenames, dtype=object)),
+            'angle': self.angle,
+            'length': self.length,
+            'p1_x': self.x1,
+            'p1_y': self.y1,
+            'p2_x': self.x2,
+            'p2_y': self.y2}, copy=False)
 
 ##################################################
 #                    Function                    #
 ##################################################
-def filterLines(lines):
-    angle_tolerance = 10
+def filterLines(lines, angle_tolerance=10, pool=None):
+    '''Connects the duplicate lines in each image.
+       The groups of lines with similar angles are independent, with a pool they are merged in parallel.'''
+    groups = [linesSameAngle for linesFilename in lines.splitByFilename()
+              for linesSameAngle in sortByAngle(linesFilename, angle_tolerance)]
+    merge = functools.partial(mergeLines, angle_tolerance=angle_tolerance)
+    linesByAngle = list(pool.map(merge, groups) if pool else map(merge, groups))
+
+    return LineSet.concatenate(linesByAngle, lines.filenames)
+
+def mergeLines(lines, angle_tolerance, sameDirection=True):
+    '''Connects lines with equal angles that are close to each other.
+       With sameDirection=False it gives the same result as calling connectTwoLinesIfPossible until it returns False,
+       but the candidates are found with a grid on the endpoints and tested vectorized.
+       By default both lines must also have the same direction, see evaluateMerges.'''
+    n = len(lines)
+    if n < 2:
+        return lines
+
+    # Every merge removes two lines and adds one, so there are at most 2n-1 lines.
+    # A line keeps its index, the order of the indices is the order of the list in connectTwoLinesIfPossible.
+    points = np.zeros((2 * n, 4), dtype=np.int64)
+    points[:n] = lines.points
+    lengths = np.zeros(2 * n)
+    lengths[:n] = lines.length
+    angles = np.zeros(2 * n)
+    angles[:n] = lines.angle
+    frame = np.zeros(2 * n, dtype=np.int32)
+    frame[:n] = lines.frame
+    alive = np.zeros(2 * n, dtype=bool)
+    alive[:n] = True
 
-    linesByAngle = sortByAngle(lines, angle_tolerance)
+    # Two lines can only be connected if their endpoints are closer than (length1 + length2) / 4
+    first, second = closePairs(points[:n], lengths[:n])
+    mergeable, longest = evaluateMerges(points, lengths, angles, first, second, angle_tolerance, sameDirection)
+    grid = LineGrid(points, lengths, n)
 
-    for linesSameAngle in linesByAngle:
-        while connectTwoLinesIfPossible(linesSameAngle, angle_tolerance):
-            pass
+    # partners[i] are the ascending indices of the lines that can be connected with line i
+    partners = [[] for _ in range(2 * n)]
+    longestLines = {}
+    for i, j, points_longest in zip(first[mergeable].tolist(), second[mergeable].tolist(), longest[mergeable].tolist()):
+        partners[i].append(j)
+        longestLines[i, j] = points_longest
 
-    # Flattens the list https://stackoverflow.com/questions/952914/making-a-flat-list-out-of-list-of-lists-in-python
-    return [item for sublist in linesByAngle for item in sublist]
+    heap = sorted({i for i in first[mergeable].tolist()})
+    inHeap = np.zeros(2 * n, dtype=bool)
+    inHeap[heap] = True
+    new = n
+
+    while heap:
+        i = heap[0]
+        while partners[i] and not alive[partners[i][0]]:
+            partners[i].pop(0)
+        if not alive[i] or not partners[i]:
+            heapq.heappop(heap)
+            inHeap[i] = False
+            continue
+
+        # The first line with a partner and its first partner are the two lines connectTwoLinesIfPossible would connect
+        j = partners[i][0]
+        x1, y1, x2, y2 = longestLines[i, j]
+        alive[[i, j]] = False
+        alive[new] = True
+        points[new] = longestLines[i, j]
+        lengths[new] = length(x1, y1, x2, y2)
+        angles[new] = angleBetween(x1, y1, x2, y2)
+        frame[new] = frame[i]
+
+        others = grid.neighbours(new)
+        others = others[alive[others]]
+        grid.add(new)
+        mergeable, longest = evaluateMerges(points, lengths, angles, others, np.full(len(others), new), angle_tolerance, sameDirection)
+        for k, points_longest in zip(others[mergeable].tolist(), longest[mergeable].tolist()):
+            partners[k].append(new)
+            longestLines[k, new] = points_longest
+            if not inHeap[k]:
+                heapq.heappush(heap, k)
+                inHeap[k] = True
+        new += 1
+
+    return LineSet(*points[alive].T, frame[alive], lines.filenames, length=lengths[alive], angle=angles[alive])
+
+def prepareBackground(background):
+    '''Converts the background once to int16 and doubles it, so that it can be subtracted from every image'''
+    return np.int16(background) * 2
+
+def subtractBackground(image, background, threshold=5):
+    '''Subtracts the prepared background and sets all pixels below the threshold to zero'''
+    # int16 allows negative values, so that the negative values (background) can be filtered.
+    result = np.subtract(image, background, dtype=np.int16)
+    result[result < threshold] = 0
+    return result.astype(np.uint8)
 
 ##################################################
 #                 Helper-Function                #
@@ -96,22 +244,225 @@ def length(x1, y1, x2, y2):
     '''Calculates the length of the line'''
     return np.sqrt((x1-x2)**2 + (y1-y2)**2)
 
+def anglesBetween(x1, y1, x2, y2):
+    '''Vectorized version of angleBetween for arrays of points'''
+    return np.degrees(np.arctan2(y2-y1, x2-x1))
+
+def lengths(x1, y1, x2, y2):
+    '''Vectorized version of length for arrays of points, calculated in int64 to avoid overflows'''
+    return length(np.int64(x1), np.int64(y1), np.int64(x2), np.int64(y2))
+
 def sortByAngle(lines, angle_tolerance):
-    '''Sorts all lines into different arrays depending on their angle'''
-    linesByAngle = []
-    angles = []
-    for i_line, line in enumerate(lines):
-        for i_angle, angle in enumerate(angles):
-            if isAlmostSameAngle(angle, line.angle, angle_tolerance):
-                linesByAngle[i_angle].append(line)
-                angles[i_angle] = (angle + line.angle) / 2
-                break
-        else:
-            angles.append(line.angle)
-            linesByAngle.append([line])
-
-    return linesByAngle
+    '''Sorts all lines into different arrays depending on their angle, works with a list of Line objects and with a LineSet'''
+    if isinstance(lines, LineSet):
+        return [lines[indices] for indices in groupByAngle(lines.angle, angle_tolerance)]
+
+    return [[lines[i] for i in indices] for indices in groupByAngle([line.angle for line in lines], angle_tolerance)]
+
+def groupByAngle(lineAngles, angle_tolerance):
+    '''Returns the indices of the lines with a similar angle.
+       The directions (angle modulo 180) are sorted and split where two neighbours differ by more than the tolerance,
+       so two lines within the tolerance are always in the same group, no matter in which order the lines are.
+       A chain of similar angles can make a group wider than the tolerance, so mergeLines checks the angles of every pair.
+       The groups are ordered by their first line and the indices in a group are ascending.'''
+    directions = np.mod(np.asarray(lineAngles, dtype=np.float64), 180)
+    if len(directions) == 0:
+        return []
+
+    order = np.argsort(directions, kind='stable')
+    sortedDirections = directions[order]
+    labels = np.concatenate([[0], np.cumsum(np.diff(sortedDirections) > angle_tolerance)])
+    # 0 and 180 degree are the same direction, so the first and the last group are joined if they are close across it
+    if labels[-1] > 0 and sortedDirections[0] + 180 - sortedDirections[-1] <= angle_tolerance:
+        labels[labels == labels[-1]] = 0
+
+    groups = np.empty(len(directions), dtype=np.int64)
+    groups[order] = labels
+    # Renumbers the groups in the order of their first line
+    _, firstLines, inverse = np.unique(groups, return_index=True, return_inverse=True)
+    groups = np.argsort(np.argsort(firstLines))[inverse]
+    indices = np.argsort(groups, kind='stable')
+    return np.split(indices, np.cumsum(np.bincount(groups))[:-1])
+
+def areSameDirections(angles1, angles2, tolerance):
+    '''Compares whether the lines have a similar direction, lines rotated by 180 degree have the same direction'''
+    difference = np.abs(angles1 - angles2) % 180
+    return np.minimum(difference, 180 - difference) <= tolerance
+
+def areAlmostSameAngles(angles1, angles2, tolerance):
+    '''Vectorized version of isAlmostSameAngle for arrays of angles'''
+    sameAngleBut180Rotated = np.where(angles1 > angles2,
+                                      np.abs((angles2 + 180) - angles1) <= tolerance,
+                                      np.abs((angles1 + 180) - angles2) <= tolerance)
+    return (np.abs(angles1 - angles2) <= tolerance) | \
+           (np.abs(angles1 - 180) <= tolerance) | \
+           (np.abs(angles1 + 180) <= tolerance) | \
+           sameAngleBut180Rotated
 
+def gridPairs(points, cellSize):
+    '''Returns all pairs of lines (first < second) with endpoints in the same or in neighbouring cells of a grid.
+       Includes every pair of lines with endpoints closer than cellSize.'''
+    first, second = gridNeighbours(points, points, cellSize)
+    pairs = np.unique(first[first < second] * len(points) + second[first < second])
+    return pairs // len(points), pairs % len(points)
+
+def gridNeighbours(points, others, cellSize):
+    '''Returns the pairs of a line of points and a line of others with endpoints in the same or in neighbouring cells
+       of a grid, a pair can be returned several times. Includes every pair of lines with endpoints closer than cellSize.'''
+    endpoints = points.reshape(-1, 2)
+    otherEndpoints = others.reshape(-1, 2)
+    if len(endpoints) == 0 or len(otherEndpoints) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # Shifted by one, so that the neighbours of a cell never wrap around to the next column
+    cells = np.floor_divide(endpoints, cellSize).astype(np.int64)
+    otherCells = np.floor_divide(otherEndpoints, cellSize).astype(np.int64)
+    origin = np.minimum(cells.min(axis=0), otherCells.min(axis=0)) - 1
+    cells -= origin
+    otherCells -= origin
+    height = max(cells[:, 1].max(), otherCells[:, 1].max()) + 2
+    keys = cells[:, 0] * height + cells[:, 1]
+    otherKeys = otherCells[:, 0] * height + otherCells[:, 1]
+    order = np.argsort(otherKeys, kind='stable')
+    sortedKeys = otherKeys[order]
+
+    first, second = [], []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            neighbours = keys + dx * height + dy
+            start = np.searchsorted(sortedKeys, neighbours, side='left')
+            counts = np.searchsorted(sortedKeys, neighbours, side='right') - start
+            # All endpoints in the neighbouring cell, for every endpoint, the endpoints 2i and 2i+1 belong to line i
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            first.append(np.repeat(np.arange(len(endpoints)), counts) // 2)
+            second.append(order[np.repeat(start, counts) + offsets] // 2)
+    return np.concatenate(first), np.concatenate(second)
+
+def lengthClasses(lengths):
+    '''Returns the class of every length, the lines of class c are shorter than 2 ** (c + 1) pixels'''
+    return np.floor(np.log2(np.maximum(lengths, 1))).astype(np.int64)
+
+def closePairs(points, lengths):
+    '''Returns all pairs of lines (first < second) whose endpoints can be closer than (length1 + length2) / 4.
+       Every pair of classes of lengths gets its own grid, so that a long track does not make the cells of the many
+       short lines large, which would make the number of candidates grow with the square of the number of lines.'''
+    classes = lengthClasses(lengths)
+    members = {c: np.flatnonzero(classes == c) for c in np.unique(classes).tolist()}
+    pairs = [np.zeros(0, dtype=np.int64)]
+    for a in members:
+        for b in members:
+            if b < a:
+                continue
+            i, j = gridNeighbours(points[members[a]], points[members[b]], (2 ** (a + 1) + 2 ** (b + 1)) / 4)
+            i, j = members[a][i], members[b][j]
+            pairs.append((np.minimum(i, j) * len(points) + np.maximum(i, j))[i != j])
+    pairs = np.unique(np.concatenate(pairs))
+    return pairs // len(points), pairs % len(points)
+
+class LineGrid:
+    '''Grids of the endpoints of the lines, one grid per class of lengths, to which the connected lines are added.
+       The cells of class c are 2 ** c pixels large, so two lines of the class that can be connected are in neighbouring cells.
+       The points and lengths are the arrays of mergeLines, which also hold the lines added later.'''
+    def __init__(self, points, lengths, count):
+        self.points = points
+        self.lengths = lengths
+        self.cells = {}     # (class, x, y) -> indices of the lines with an endpoint in the cell
+        self.members = {}   # class -> indices of the lines
+        for index in range(count):
+            self.add(index)
+
+    def add(self, index):
+        c = int(lengthClasses(self.lengths[index]))
+        x1, y1, x2, y2 = self.points[index].tolist()
+        self.members.setdefault(c, []).append(index)
+        for x, y in ((x1, y1), (x2, y2)):
+            self.cells.setdefault((c, x >> c, y >> c), []).append(index)
+
+    def neighbours(self, index):
+        '''Returns the ascending indices of the lines with an endpoint closer than (length1 + length2) / 4 to an endpoint of the line'''
+        x1, y1, x2, y2 = self.points[index].tolist()
+        candidates = [np.zeros(0, dtype=np.int64)]
+        for c, members in self.members.items():
+            reach = math.ceil((self.lengths[index] + 2 ** (c + 1)) / 4 / 2 ** c)
+            # For a long line and short lines it is faster to test all of them than to look into every cell
+            if 2 * (2 * reach + 1) ** 2 * 8 >= len(members):
+                candidates.append(np.array(members, dtype=np.int64))
+                continue
+            found = []
+            for x, y in ((x1, y1), (x2, y2)):
+                for dx in range(-reach, reach + 1):
+                    for dy in range(-reach, reach + 1):
+                        found.extend(self.cells.get((c, (x >> c) + dx, (y >> c) + dy), ()))
+            candidates.append(np.array(found, dtype=np.int64))
+        candidates = np.concatenate(candidates)
+
+        # The same test of the distance as in evaluateMerges, a line found in several cells is returned once
+        endpoints = self.points[candidates].reshape(-1, 2, 1, 2)
+        distances = np.sqrt(((endpoints - self.points[index].reshape(1, 1, 2, 2)) ** 2).sum(axis=-1)).min(axis=(1, 2))
+        candidates = candidates[(distances <= (self.lengths[index] + self.lengths[candidates]) / 4) & (candidates != index)]
+        return np.unique(candidates)
+
+def evaluateMerges(points, lengths, angles, first, second, angle_tolerance, sameDirection=True):
+    '''Vectorized test of connectTwoLinesIfPossible for the pairs of lines (first, second).
+       Returns whether each pair can be connected and the points of the connected lines.
+       Unlike connectTwoLinesIfPossible, which compares only the first line with the connection, with sameDirection both
+       lines must have the same direction. The groups of sortByAngle ensured this before, but a group of groupByAngle
+       can be wider than the tolerance.'''
+    x1, y1, x2, y2 = points[first].T
+    x3, y3, x4, y4 = points[second].T
+
+    # Same order of the candidates as calculateShortestLine and calculateLongestLine, so that ties are resolved equally
+    shortCandidates = np.stack([np.stack(c, axis=-1) for c in [(x1, y1, x3, y3), (x1, y1, x4, y4), (x2, y2, x3, y3), (x2, y2, x4, y4)]], axis=1)
+    longCandidates = np.stack([np.stack(c, axis=-1) for c in [(x1, y1, x2, y2), (x1, y1, x3, y3), (x1, y1, x4, y4),
+                                                               (x2, y2, x3, y3), (x2, y2, x4, y4), (x3, y3, x4, y4)]], axis=1)
+
+    shortLengths = length(shortCandidates[..., 0], shortCandidates[..., 1], shortCandidates[..., 2], shortCandidates[..., 3])
+    longLengths = length(longCandidates[..., 0], longCandidates[..., 1], longCandidates[..., 2], longCandidates[..., 3])
+    rows = np.arange(len(first))
+    shortest = shortCandidates[rows, np.argmin(shortLengths, axis=1)]
+    longest = longCandidates[rows, np.argmax(longLengths, axis=1)]
+
+    shortestLength = length(*shortest.T)
+    shortestAngle = anglesBetween(*shortest.T)
+    longestAngle = anglesBetween(*longest.T)
+    maximumDistance = (lengths[first] + lengths[second]) / 4
+
+    mergeable = ~(shortestLength > maximumDistance) & \
+                (areAlmostSameAngles(shortestAngle, angles[first], angle_tolerance) |
+                 (shortestLength < maximumDistance) & areAlmostSameAngles(longestAngle, angles[first], angle_tolerance))
+    if sameDirection:
+        mergeable &= areSameDirections(angles[first], angles[second], angle_tolerance)
+    return mergeable, longest
+
+def linePalette(colors):
+    '''Returns colors of evenly spaced hues as BGR, bright enough to be seen on the dark images'''
+    hues = np.arange(colors) * 180 // colors  # The hue of OpenCV goes from 0 to 179
+    hsv = np.stack([hues, np.full(colors, 255), np.full(colors, 255)], axis=1).astype(np.uint8)
+    return cv2.cvtColor(hsv[np.newaxis], cv2.COLOR_HSV2BGR)[0].tolist()
+
+# Lines with similar angles get the same color, so the colors are the same in every run
+LINE_COLORS = linePalette(12)
+
+def colorImageWithLines(lines, image, scale=1, thickness=3):
+    '''Returns a color copy of the grayscale image with the lines drawn in it, reduced to scale.
+       All lines of one color are drawn with one call of cv2.polylines.'''
+    if scale != 1:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+
+    segments = np.rint(lines.points * scale).astype(np.int32).reshape(-1, 2, 2)
+    colors = (np.mod(lines.angle, 180) * len(LINE_COLORS) // 180).astype(np.int64) % len(LINE_COLORS)
+    order = np.argsort(colors, kind='stable')
+    bounds = np.searchsorted(colors[order], np.arange(len(LINE_COLORS) + 1))
+    for color, start, end in zip(LINE_COLORS, bounds[:-1], bounds[1:]):
+        if start < end:
+            cv2.polylines(image, segments[order[start:end]], False, color, thickness=max(1, round(thickness * scale)))
+    return image
+
+##################################################
+#             Unused Helper-Function             #
+##################################################
+# Reference implementation of mergeLines, kept for the tests
 def calculateShortestLine(x1,y1,x2,y2,x3,y3,x4,y4,filename):
    '''Calculates the shortest line from all points'''
    shortest = np.argmin([length(x1,y1,x3,y3), length(x1,y1,x4,y4), length(x2,y2,x3,y3), length(x2,y2,x4,y4)])
@@ -165,15 +516,6 @@ def connectTwoLinesIfPossible(lines, angle_tolerance):
                 return True
     return False
 
-def colorImageWithLines(lines, image):
-    '''Draws lines in the given image'''
-    for line in lines:
-        cv2.line(image, (line.x1, line.y1), (line.x2, line.y2), color=(randint(100, 255), randint(100, 255), randint(100, 255)), thickness=3)
-    return image
-
-##################################################
-#             Unused Helper-Function             #
-##################################################
 def getPointsOnLine(line):
     '''Creates points on lines with even spacing'''
     (x1,y1,x2,y2) = line